@@ -0,0 +1,102 @@
+'''
+Benchmark of the inference backends on the CPU.
+Run a small randomly initialized timm model, so that nothing is downloaded, with
+each backend on the same inputs and compare the throughput and the tags with eager
+execution: the agreement of the tags over the threshold and the largest difference
+of the probabilities. Fail if the agreement of a backend is under its tolerance.
+Random weights tell images apart far less than trained ones, which makes the int8
+agreement pessimistic, load the weights of a tagger with --checkpoint for a real check.
+
+    python bench/backends.py --images 64 --batch_size 16 --threads 4
+    python bench/backends.py --backends eager int8 onnx --arch vit_small_patch16_224
+    python bench/backends.py --arch vit_base_patch16_224 --labels 10861 --checkpoint path/to/model.safetensors
+'''
+from dataclasses import dataclass
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+from simple_parsing import field, ArgumentParser
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent/'src'))
+from controllers.infer import BACKENDS, LabelData, TaggerModel, _predict, get_backend
+
+def _tagger(arch: str, labels: int, checkpoint: Optional[Path], seed: int) -> TaggerModel:
+    import timm
+    import torch
+    torch.manual_seed(seed)
+    if checkpoint is not None:
+        model = timm.create_model(arch, pretrained=False, num_classes=labels, checkpoint_path=str(checkpoint)).eval()
+    else:
+        model = timm.create_model(arch, pretrained=False, num_classes=labels).eval()
+        # a random head gives probabilities close to 0.5, spread them to about 20 tags per image like a tagger
+        with torch.no_grad():
+            head = model.get_classifier()
+            head.weight.mul_(6)
+            head.bias.fill_(-4)
+    names = [f'tag_{i}' for i in range(labels)]
+    return TaggerModel(arch, f'local/{arch}', model, LabelData(names, np.zeros(0, dtype=np.int64),
+                       np.arange(labels), np.zeros(0, dtype=np.int64)), None)
+
+def _agreement(a: np.ndarray, b: np.ndarray, threshold: float) -> float:
+    # mean over images of the intersection over union of the tags over the threshold
+    a, b = a > threshold, b > threshold
+    union = (a | b).sum(axis=1)
+    return float(np.mean(np.where(union > 0, (a & b).sum(axis=1) / np.maximum(union, 1), 1.0)))
+
+@dataclass
+class Bench:
+    backends: List[str] = field(default_factory=lambda: list(BACKENDS), help='Backends to compare with eager execution')
+    arch: str = field(default='vit_tiny_patch16_224', help='timm architecture of the model')
+    labels: int = field(default=1000, help='Number of labels of the model')
+    checkpoint: Optional[Path] = field(default=None, help='Weights of the model, random when not given')
+    images: int = field(default=64, help='Number of synthetic images')
+    batch_size: int = field(default=16, help='Number of images run through the model at once')
+    threads: Optional[int] = field(default=None, help='Number of threads used within each operator, one per core by default')
+    threshold: float = field(default=0.35, help='Threshold of the tags')
+    tolerance: float = field(default=0.95, help='Minimum agreement of the tags with eager execution')
+    int8_tolerance: float = field(default=0.85, help='Minimum agreement of the tags of the int8 backend, which approximates the weights')
+    seed: int = field(default=0, help='Random seed')
+    def run(self):
+        import torch
+        for backend in self.backends:
+            if backend not in BACKENDS:
+                raise ValueError(f'Unknown backend "{backend}". Available backends: {BACKENDS}')
+        if self.threads is not None:
+            torch.set_num_threads(self.threads)
+        tagger = _tagger(self.arch, self.labels, self.checkpoint, self.seed)
+        shape = tagger.model.pretrained_cfg['input_size']
+        inputs = torch.from_numpy(np.random.default_rng(self.seed).normal(0, 0.5, size=(self.images, ) + tuple(shape)).astype(np.float32))
+        batches = list(inputs.split(self.batch_size))
+        device = torch.device('cpu')
+        results = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            for backend in ['eager'] + [b for b in self.backends if b != 'eager']:
+                start = time.perf_counter()
+                runner = get_backend(tagger, backend, self.threads, Path(tmp))
+                # the first batch compiles, traces or warms up the backend
+                _predict(batches[0], runner, device)
+                setup = time.perf_counter() - start
+                start = time.perf_counter()
+                probs = np.concatenate([_predict(b, runner, device) for b in batches])
+                results[backend] = (setup, self.images / (time.perf_counter() - start), probs)
+        reference = results['eager'][2]
+        print(f'{"backend":>8} {"setup s":>8} {"images/s":>9} {"speedup":>8} {"agreement":>9} {"max diff":>9}')
+        failed = []
+        for backend, (setup, speed, probs) in results.items():
+            agreement = _agreement(reference, probs, self.threshold)
+            print(f'{backend:>8} {setup:8.2f} {speed:9.1f} {speed / results["eager"][1]:7.2f}x ' \
+                  f'{agreement:9.4f} {np.abs(reference - probs).max():9.4f}')
+            tolerance = self.int8_tolerance if backend == 'int8' else self.tolerance
+            if agreement < tolerance:
+                failed.append(f'{backend} {agreement:.4f} < {tolerance}')
+        if failed:
+            print(f'agreement under the tolerance: {", ".join(failed)}', file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_arguments(Bench, dest='bench')
+    parser.parse_args().bench.run()
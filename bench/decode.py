@@ -0,0 +1,123 @@
+'''
+Benchmark of the reduced-resolution decode of inference preprocessing.
+Compare the full decode with the fast decode on large images: the CPU time and
+the peak memory of each image, measured in a fresh interpreter, and the difference
+of the model inputs. Fail if the difference exceeds the tolerance.
+
+    python bench/decode.py --images 4 --width 4000 --height 3000
+    python bench/decode.py --directory path/to/photos
+'''
+from dataclasses import dataclass
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+from PIL import Image
+from simple_parsing import field, ArgumentParser
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT/'src'))
+from controllers.infer import _load_image
+
+# the preprocessing of the tagger models
+TRANSFORM = dict(input_size=(3, 448, 448), interpolation='bicubic', crop_pct=1.0, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5))
+
+# run in a fresh interpreter, with the peak memory reset after the imports (Linux only)
+_MEASURE = '''
+import json, sys, tempfile, time
+sys.path.insert(0, 'src')
+from PIL import Image
+from timm.data import create_transform
+from controllers.infer import _load_image
+file, size, transform, runs = json.loads(sys.argv[1])
+transform = create_transform(**transform)
+with tempfile.NamedTemporaryFile(suffix='.png') as warmup:
+    Image.new('RGB', (64, 64)).save(warmup.name)
+    _load_image(warmup.name, transform, size)
+def peak():
+    # high water mark of the resident memory in kB
+    with open('/proc/self/status') as f:
+        return next(int(l.split()[1]) for l in f if l.startswith('VmHWM:'))
+# reset the high water mark to the current resident memory
+with open('/proc/self/clear_refs', 'w') as f:
+    f.write('5')
+base = peak()
+start = time.process_time()
+for _ in range(runs):
+    _load_image(file, transform, size)
+cpu = time.process_time() - start
+print(json.dumps([cpu / runs, peak() - base]))
+'''
+
+def _measure(file: str, size: Optional[int], runs: int) -> tuple[float, float]:
+    # CPU seconds and peak memory increase in MB of preprocessing the image
+    p = subprocess.run([sys.executable, '-c', _MEASURE, json.dumps([file, size, TRANSFORM, runs])],
+                       cwd=ROOT, capture_output=True, text=True)
+    if p.returncode != 0:
+        raise RuntimeError(f'Failed to measure {file}:\n{p.stderr}')
+    cpu, peak = json.loads(p.stdout.splitlines()[-1])
+    return cpu, peak / 1024
+
+def _synthetic(directory: Path, count: int, width: int, height: int, seed: int) -> List[str]:
+    # smooth gradients with noise and shapes, in the formats and modes of a dataset
+    rng = np.random.default_rng(seed)
+    files: List[str] = []
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    for i in range(count):
+        a, b, c = rng.uniform(0.5, 4.0, size=3)
+        base = np.stack([np.sin(x / width * a * 6) , np.cos(y / height * b * 6), np.sin((x + y) / (width + height) * c * 6)], axis=-1)
+        pixels = ((base * 0.5 + 0.5) * 200 + rng.normal(0, 3, size=(height, width, 3))).clip(0, 255).astype(np.uint8)
+        image = Image.fromarray(pixels)
+        kind = ['jpg', 'png', 'webp', 'rgba'][i % 4]
+        if kind == 'rgba':
+            alpha = (((x - width / 2) ** 2 + (y - height / 2) ** 2) < (min(width, height) / 2.5) ** 2).astype(np.uint8) * 255
+            image.putalpha(Image.fromarray(alpha))
+            kind = 'png'
+        path = directory/f'{i:03d}.{kind}'
+        image.save(path, quality=90) if kind in ('jpg', 'webp') else image.save(path)
+        files.append(str(path))
+    return files
+
+@dataclass
+class Bench:
+    directory :Optional[Path] = field(default=None, help='Directory of images to use instead of synthetic ones')
+    images :int = field(default=4, help='Number of synthetic images, cycling through JPEG, PNG, WebP and RGBA PNG')
+    width :int = field(default=4000, help='Width of the synthetic images')
+    height :int = field(default=3000, help='Height of the synthetic images')
+    tolerance :float = field(default=0.05, help='Maximum mean absolute difference of the model inputs, which range from -1 to 1')
+    runs :int = field(default=3, help='Number of times each image is preprocessed')
+    seed :int = field(default=0, help='Random seed')
+    def run(self):
+        from timm.data import create_transform
+        with tempfile.TemporaryDirectory() as tmp:
+            if self.directory is None:
+                files = _synthetic(Path(tmp), self.images, self.width, self.height, self.seed)
+            else:
+                files = sorted(str(p) for p in self.directory.iterdir() if p.suffix.lower() in ('.jpg', '.jpeg', '.png', '.webp'))
+            size = TRANSFORM['input_size'][-1]
+            transform = create_transform(**TRANSFORM)
+            print(f'{"image":>12} {"full ms":>9} {"fast ms":>9} {"full MB":>9} {"fast MB":>9} {"mean diff":>9} {"max diff":>9}')
+            totals = np.zeros(4)
+            worst = 0.0
+            for f in files:
+                full_cpu, full_peak = _measure(f, None, self.runs)
+                fast_cpu, fast_peak = _measure(f, size, self.runs)
+                diff = (_load_image(f, transform) - _load_image(f, transform, size)).abs()
+                worst = max(worst, diff.mean().item())
+                totals += [full_cpu, fast_cpu, full_peak, fast_peak]
+                print(f'{Path(f).name:>12} {full_cpu * 1000:9.1f} {fast_cpu * 1000:9.1f} {full_peak:9.1f} {fast_peak:9.1f} ' \
+                      f'{diff.mean().item():9.4f} {diff.max().item():9.4f}')
+            full_cpu, fast_cpu, full_peak, fast_peak = totals / len(files)
+            print(f'{"mean":>12} {full_cpu * 1000:9.1f} {fast_cpu * 1000:9.1f} {full_peak:9.1f} {fast_peak:9.1f}')
+            print(f'CPU time {full_cpu / fast_cpu:.1f}x less, peak memory {full_peak / max(fast_peak, 0.1):.1f}x less')
+        if worst > self.tolerance:
+            print(f'mean difference {worst:.4f} is over the tolerance of {self.tolerance}', file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_arguments(Bench, dest='bench')
+    parser.parse_args().bench.run()
@@ -0,0 +1,77 @@
+'''
+Micro-benchmark of tag thresholding.
+Compare the vectorized _get_tags with the former per-label implementation
+on synthetic labels and check that both give the same captions.
+
+    python bench/get_tags.py --images 256 --labels 10000
+'''
+from dataclasses import dataclass
+import sys
+import time
+from pathlib import Path
+from typing import List
+import numpy as np
+from simple_parsing import field, ArgumentParser
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent/'src'))
+from controllers.infer import LabelData, _get_tags
+
+def _get_tags_legacy(probs: np.ndarray, labels: LabelData, gen_threshold: float, char_threshold: float):
+    # Implementation before vectorization, kept as the reference
+    probs = list(zip(labels.names, probs))
+    rating_labels = dict([probs[i] for i in labels.rating])
+    gen_labels = [probs[i] for i in labels.general]
+    gen_labels = dict([x for x in gen_labels if x[1] > gen_threshold])
+    gen_labels = dict(sorted(gen_labels.items(), key=lambda item: item[1], reverse=True))
+    char_labels = [probs[i] for i in labels.character]
+    char_labels = dict([x for x in char_labels if x[1] > char_threshold])
+    char_labels = dict(sorted(char_labels.items(), key=lambda item: item[1], reverse=True))
+    combined_names = [x for x in char_labels]
+    combined_names.extend([x.replace('_', ' ') for x in gen_labels])
+    tags = ','.join(combined_names)
+    taglist = tags.replace('(', '\\(').replace(')', '\\)')
+    return [x.strip() for x in taglist.split(',')]
+
+def _labels(count: int, rng: np.random.Generator) -> LabelData:
+    category = rng.choice([0, 4], size=count, p=[0.8, 0.2])
+    category[:4] = 9
+    names = [f'tag_{i}_(series)' if c == 4 else f'tag_{i}' for i, c in enumerate(category)]
+    return LabelData(names=names,
+                     rating=np.where(category == 9)[0],
+                     general=np.where(category == 0)[0],
+                     character=np.where(category == 4)[0])
+
+@dataclass
+class Bench:
+    images :int = field(default=256, help='Number of images')
+    labels :int = field(default=10000, help='Number of labels')
+    gen_threshold :float = field(default=0.35, help='Threshold for general tags')
+    char_threshold :float = field(default=0.75, help='Threshold for character tags')
+    seed :int = field(default=0, help='Random seed')
+    def run(self):
+        rng = np.random.default_rng(self.seed)
+        labels = _labels(self.labels, rng)
+        # most labels are unlikely, like a real tagger output
+        probs = rng.beta(0.3, 6.0, size=(self.images, self.labels)).astype(np.float32)
+        # quantize a bit so that ties are exercised as well
+        probs = np.round(probs, 3)
+
+        start = time.perf_counter()
+        legacy: List[List[str]] = [_get_tags_legacy(p, labels, self.gen_threshold, self.char_threshold) for p in probs]
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vectorized = _get_tags(probs, labels, self.gen_threshold, self.char_threshold)
+        vectorized_time = time.perf_counter() - start
+
+        if legacy != vectorized:
+            mismatch = sum(1 for a, b in zip(legacy, vectorized) if a != b)
+            raise AssertionError(f'{mismatch} of {self.images} captions differ')
+        print(f'legacy     {legacy_time * 1000:9.2f} ms ({legacy_time / self.images * 1e6:8.1f} us/image)')
+        print(f'vectorized {vectorized_time * 1000:9.2f} ms ({vectorized_time / self.images * 1e6:8.1f} us/image)')
+        print(f'speedup    {legacy_time / vectorized_time:9.1f}x')
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_arguments(Bench, dest='bench')
+    parser.parse_args().bench.run()
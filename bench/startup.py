@@ -0,0 +1,67 @@
+'''
+Startup benchmark of the REPL.
+Import src/app.py in a fresh interpreter with -X importtime, report the slowest
+imports and fail if the startup exceeds the budget or pulls in the inference stack.
+
+    python bench/startup.py --budget 200 --runs 5
+'''
+from dataclasses import dataclass
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+from simple_parsing import field, ArgumentParser
+
+ROOT = Path(__file__).resolve().parent.parent
+# modules which must only be imported when a command needs them
+DEFERRED = ['torch', 'torchvision', 'timm', 'PIL', 'numpy', 'pandas', 'huggingface_hub', 'Levenshtein']
+
+def _import_app() -> Tuple[float, str]:
+    code = "import sys; sys.path.insert(0, 'src'); import app"
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                       cwd=ROOT, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if p.returncode != 0:
+        raise RuntimeError(f'Failed to import app:\n{p.stderr.splitlines()[-1]}')
+    return elapsed, p.stderr
+
+def _parse(log: str) -> Dict[str, int]:
+    # "import time: self [us] | cumulative | imported package", nested imports are indented
+    cumulative: Dict[str, int] = {}
+    for line in log.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, total, name = line[len('import time:'):].split('|')
+        cumulative[name.strip()] = int(total)
+    return cumulative
+
+@dataclass
+class Bench:
+    budget :float = field(default=200, help='Maximum startup time in milliseconds')
+    runs :int = field(default=5, help='Number of interpreters to start, the fastest one is reported')
+    top :int = field(default=10, help='Number of slowest imports to show')
+    def run(self):
+        results = [_import_app() for _ in range(self.runs)]
+        elapsed, log = min(results, key=lambda r: r[0])
+        cumulative = _parse(log)
+        slowest: List[Tuple[str, int]] = sorted(cumulative.items(), key=lambda x: x[1], reverse=True)
+        for name, total in slowest[:self.top]:
+            print(f'{total / 1000:9.2f} ms {name}')
+        print(f'startup    {elapsed * 1000:9.2f} ms (budget {self.budget:.0f} ms)')
+
+        failures: List[str] = []
+        loaded = [m for m in DEFERRED if m in cumulative]
+        if loaded:
+            failures.append(f'deferred modules imported at startup: {", ".join(loaded)}')
+        if elapsed * 1000 > self.budget:
+            failures.append(f'startup took {elapsed * 1000:.0f} ms, over the budget of {self.budget:.0f} ms')
+        for f in failures:
+            print(f, file=sys.stderr)
+        sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_arguments(Bench, dest='bench')
+    parser.parse_args().bench.run()
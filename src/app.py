@@ -3,7 +3,9 @@ import os
 import sys
 import readline
 import shlex
+import time
 from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
 from simple_parsing import field, ArgumentParser
 from models.context import Context
 from commands.cli import Cli
@@ -12,34 +14,90 @@ from pathlib import Path
 @dataclass
 class App:
     path :Path = field(positional=True, help='Path to the directory to read')
-    def run(self):
-        context = Context(path=self.path)
+    index :bool = field(default=False, help='Keep an index of the files in the directory to load faster next time')
+    file :Optional[Path] = field(default=None, alias='-f', help='Run the commands of a file, one per line, then exit. - reads standard input')
+    command :List[str] = field(default_factory=list, alias='-c', help='Run the commands, then exit')
+    time :bool = field(default=False, help='Print the time taken by each command')
+    watch :bool = field(default=False, help='Watch the directory and apply changes made by other programs before each command')
+    _parser :ArgumentParser = field(default=None, cmd=False)
+    def parse(self, line: str) -> Cli:
+        # building the parser walks the whole command tree, do it once
+        if self._parser is None:
+            self._parser = ArgumentParser()
+            self._parser.add_arguments(Cli, dest='cli')
+        return self._parser.parse_args(shlex.split(line)).cli
+    def execute(self, context: Context, line: str) -> bool:
+        '''
+        Run a command line and return whether it succeeded.
+        '''
+        start = time.perf_counter()
+        try:
+            context.sync()
+            # the edits of a command are undone together
+            context.dataset.journal.begin(line)
+            try:
+                self.parse(line).run(context)
+            finally:
+                context.dataset.journal.end()
+            return True
+        except SystemExit as e:
+            # raised by the parser, after printing the usage or the help
+            return e.code in (None, 0)
+        except Exception as e:
+            logging.exception(f"⚠ {e}")
+            return False
+        finally:
+            if self.time:
+                print(f'{time.perf_counter() - start:8.3f}s {line}', file=sys.stderr)
+    def script(self) -> Optional[Iterable[Tuple[str, str]]]:
+        '''
+        Return the (location, command line) to run when not interactive.
+        '''
+        if self.command:
+            return ((f'-c #{i + 1}', line) for i, line in enumerate(self.command))
+        if self.file is not None and str(self.file) != '-':
+            with open(self.file, 'r') as f:
+                lines = f.read().splitlines()
+            return ((f'{self.file}:{i + 1}', line) for i, line in enumerate(lines))
+        if self.file is not None or not sys.stdin.isatty():
+            return ((f'<stdin>:{i + 1}', line.rstrip('\n')) for i, line in enumerate(sys.stdin))
+        return None
+    def run(self) -> int:
+        script = self.script()
+        if script is None:
+            print('ctrl+d to exit.')
+        context = Context(path=self.path, index=self.index, watch=self.watch)
+        if script is None:
+            self.interact(context)
+            return 0
+        for location, line in script:
+            if context.exiting:
+                break
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            if not self.execute(context, line):
+                print(f'Stopped at {location}: {line}', file=sys.stderr)
+                return 1
+        return 0
+    def interact(self, context: Context):
         while context.exiting == False:
             try:
                 line = input('> ')
-                args = shlex.split(line)
-                parser = ArgumentParser()
-                parser.add_arguments(Cli, dest='cli')
-                cli = parser.parse_args(args).cli
-                cli.run(context)
+                self.execute(context, line)
             except EOFError:
                 break
             except KeyboardInterrupt:
                 print()
-            except SystemExit as e:
-                pass
-            except Exception as e:
-                logging.exception(f"⚠ {e}")
 
 def main():
-    print('ctrl+d to exit.')
     parser = ArgumentParser()
     parser.add_arguments(App, dest='app')
     app = parser.parse_args().app
-    app.run()
+    sys.exit(app.run())
 
 if __name__ == '__main__':
-    log_level = os.environ.get('TAGGER_LOG_LEVEL', 'WARN').upper() 
+    log_level = os.environ.get('TAGGER_LOG_LEVEL', 'WARN').upper()
     logging.basicConfig(level=log_level)
     log = logging.getLogger(__name__)
     main()
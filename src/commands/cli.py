@@ -7,18 +7,25 @@ from commands.files import Files, SelectFiles
 from commands.exit import Exit
 from commands.route import Add, Remove, List, Diff, Save
 from commands.reload import Reload
+from commands.history import Undo, Redo
+from commands.models import Models
+from commands.tensors import Tensors
 
 @dataclass
 class Cli:
     command :Any = subparsers(
         {'tags': Tags,
          'files': Files,
+         'models': Models,
+         'tensors': Tensors,
          'add': Add,
          'remove': Remove,
          'list': List,
          'select': SelectFiles,
          'diff': Diff,
          'save': Save,
+         'undo': Undo,
+         'redo': Redo,
          'reload': Reload,
          'exit': Exit,
          })
@@ -11,23 +11,24 @@ class SelectFiles:
     exprs :List[str] = field(positional=True, hint='List of expressions to select files')
     strict :bool = field(default=False, help='Use strict matching')
     all :bool = field(default=False, help='Select all files')
+    query :str = field(default=None, help='Select files by tags, e.g. "1girl AND (red hair OR blue hair) AND NOT solo"')
     def run(self, context :Context):
         c = Captions(context)
         if self.all:
             count = c.select_all_files()
-        elif self.exprs:
+        elif self.exprs or self.query is not None:
             if not self.strict:
                 self.exprs = [f'.*{e}.*' for e in self.exprs]
-            count = c.select_files(self.exprs)
+            count = c.select_files(self.exprs, query=self.query)
         else:
-            raise ValueError('Must provide expressions or use --all')
+            raise ValueError('Must provide expressions, a query or use --all')
         print(f'{count} file{"s" if count>1 else ""} selected')
 
 @dataclass
 class ListFiles:
     absolute :bool = field(default=False, help='Show as absolute path')
     all :bool = field(default=False, help='Show only selected files')
-    tag :str = field(default=None, help='Filter by tag')
+    tag :str = field(default=None, help='Show only files with a tag containing this text, or starting with it after ^')
     sort :bool = field(default=False, help='Sort tags')
     def run(self, context :Context):
         c = Captions(context)
@@ -60,10 +61,21 @@ class DiffFiles:
 
 @dataclass
 class SaveFiles:
+    dry_run :bool = field(default=False, help='List modified files without saving them')
+    absolute :bool = field(default=False, help='Show as absolute path')
     def run(self, context :Context):
         c = Captions(context)
-        count = c.save()
-        print(f"{count} file{'s' if count>1 else ''} saved")
+        r = c.save(dry_run=self.dry_run)
+        if self.dry_run:
+            for i in r.pending:
+                p = i.path if self.absolute else c.relative(context.root_path, i.path)
+                changes = [f'+{t}' for t in i.added] + [f'-{t}' for t in i.removed]
+                print(f"* {p}: {', '.join(changes) if changes else '(order)'}")
+            print(f"{len(r.pending)} file{'s' if len(r.pending)>1 else ''} to be saved")
+            return
+        for p, e in r.failed:
+            print(f'⚠ {p}: {e}')
+        print(f"{r.saved} file{'s' if r.saved>1 else ''} saved in {r.elapsed:.2f}s")
 
 @dataclass
 class Files(ListFiles):
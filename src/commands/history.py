@@ -0,0 +1,32 @@
+from dataclasses import dataclass
+from typing import Optional
+from simple_parsing import field
+from models.context import Context
+from models.journal import JournalEntry
+
+def _report(verb: str, entry: Optional[JournalEntry]):
+    if entry is None:
+        print(f'Nothing to {verb.lower()}')
+        return
+    print(f'{verb}: {entry.label} ({entry.files} file{"s" if entry.files>1 else ""}, ' \
+          f'{entry.rows} row{"s" if entry.rows>1 else ""})')
+
+@dataclass
+class Undo:
+    steps :int = field(default=1, help='Number of commands to undo')
+    def run(self, context :Context):
+        for _ in range(self.steps):
+            entry = context.dataset.journal.undo()
+            _report('Undo', entry)
+            if entry is None:
+                break
+
+@dataclass
+class Redo:
+    steps :int = field(default=1, help='Number of commands to redo')
+    def run(self, context :Context):
+        for _ in range(self.steps):
+            entry = context.dataset.journal.redo()
+            _report('Redo', entry)
+            if entry is None:
+                break
@@ -0,0 +1,58 @@
+from typing import Any, List
+from dataclasses import dataclass
+from simple_parsing import field, subparsers
+from models.context import Context
+from models.config import model_repo_map
+
+def _megabytes(size: int) -> str:
+    return f'{size / 1024 / 1024:8.1f} MB'
+
+@dataclass
+class LoadModels:
+    models :List[str] = field(positional=True, hint='Models to load. vit, swinv2, convnext or eva02')
+    def run(self, context :Context):
+        from controllers.infer import get_model
+        for name in self.models:
+            get_model(name, context.models)
+            print(f'{name} loaded')
+
+@dataclass
+class UnloadModels:
+    models :List[str] = field(positional=True, default_factory=list, hint='Models to unload')
+    all :bool = field(default=False, help='Unload all models')
+    def run(self, context :Context):
+        if self.all:
+            names = context.models.clear()
+        elif self.models:
+            names = []
+            for name in self.models:
+                if context.models.pop(name) is None:
+                    print(f'{name} is not loaded')
+                else:
+                    names.append(name)
+        else:
+            raise ValueError('Must provide models or use --all')
+        for name in names:
+            print(f'{name} unloaded')
+
+@dataclass
+class StatusModels:
+    def run(self, context :Context):
+        entries = context.models.list()
+        for e in reversed(entries):
+            print(f'* {e.key:10s} {_megabytes(e.size)} {e.value.repo_id}')
+        for name, repo_id in model_repo_map().items():
+            if name not in context.models:
+                print(f'  {name:10s} {"-":>11s} {repo_id}')
+        print(f'{_megabytes(context.models.used)} / {_megabytes(context.models.budget).strip()} used')
+
+@dataclass
+class Models(StatusModels):
+    command :Any = subparsers(default=None,
+                              subcommands={'load': LoadModels,
+                                           'unload': UnloadModels,
+                                           'status': StatusModels})
+    def run(self, context :Context):
+        if self.command:
+            return self.command.run(context)
+        return super().run(context)
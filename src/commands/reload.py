@@ -1,7 +1,20 @@
 from dataclasses import dataclass
+from simple_parsing import field
 from models.context import Context
 
 @dataclass
 class Reload:
+    discard :bool = field(default=False, help='Discard unsaved tags of all files')
     def run(self, context :Context):
-        context.__init__(context.root_path)
\ No newline at end of file
+        r = context.dataset.load(context.root_path, discard=self.discard).last_load
+        print(f'{r.added} added, {r.changed} changed, {r.deleted} deleted, {r.unchanged} unchanged ' \
+              f'in {r.elapsed:.2f}s ({r.files_per_second:.0f} files/s)')
+        if r.conflicts and not self.discard:
+            print(f'{len(r.conflicts)} file{"s" if len(r.conflicts)>1 else ""} changed on disk but kept unsaved tags:')
+            for p in r.conflicts:
+                print(f'* {p}')
+            print('Use save to overwrite them or reload --discard to take the files on disk')
+        if r.lost:
+            print(f'{len(r.lost)} file{"s" if len(r.lost)>1 else ""} deleted on disk, their unsaved tags are lost:')
+            for p in r.lost:
+                print(f'* {p}')
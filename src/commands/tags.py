@@ -1,11 +1,14 @@
 from typing import *
 from dataclasses import dataclass
 from simple_parsing import field, subparsers
-from tqdm import tqdm
 from models.context import Context
 from controllers.tags import Tags as TagsController
 from controllers.captions import Captions
-from controllers.infer import infer_tags
+from controllers.bulk import MutationResult
+
+def _report(result: MutationResult):
+    print(f'{result.files} file{"s" if result.files>1 else ""} updated ' \
+          f'({result.rows} row{"s" if result.rows>1 else ""} in {result.elapsed:.3f}s)')
 
 
 @dataclass
@@ -14,29 +17,26 @@ class AddTags:
     tail :Optional[bool] = field(default=False, hint='Add the tags to the end of the list')
     def run(self, context :Context):
         c = TagsController(context)
-        count = c.add(self.tags, tail=self.tail)
-        print(f'{count} file{'s' if count>1 else ''} updated')
+        _report(c.add(self.tags, tail=self.tail))
 
 @dataclass
 class RemoveTags:
     tags :List[str] = field(positional=True, hint='Tags to remove')
     def run(self, context :Context):
         c = TagsController(context)
-        count = c.remove(self.tags)
-        print(f'{count} file{'s' if count>1 else ''} updated')
+        _report(c.remove(self.tags))
 
 @dataclass
 class ListTags:
     threshold :Optional[int] = field(default=None, hint='Minimum count to show the caption')
     head :Optional[int] = field(default=None, hint='Show only the top N tags')
     skip :Optional[int] = field(default=None, hint='Skip the first N tags')
-    filter :Optional[str] = field(default=None, hint='Filter the tags')
+    filter :Optional[str] = field(default=None, hint='Show only the tags containing this text, or starting with it after ^')
     def run(self, context :Context):
         c = TagsController(context)
         kv = {k:v for k,v in self.__dict__.items() if v is not None}
-        index = c.list(**kv)
-        for i in index:
-            text = context.lookup(i.tag)
+        index = list(c.list(**kv))
+        for i, text in zip(index, context.lookup_many(i.tag for i in index)):
             print(f'{i.count:4d} {i.tag}, {text}')
 
 @dataclass
@@ -57,14 +57,49 @@ class InferTags:
     overwrite: bool = field(default=False, help='Overwrite existing tags')
     append: bool = field(default=False, help='Append to existing tags')
     model: list[str] = field(default='vit', help='Model to use for inference. vit, swinv2 or convnext')
+    gen: float = field(default=0.35, help='Threshold for general tags')
+    char: float = field(default=0.75, help='Threshold for character tags')
+    batch_size: int = field(default=1, help='Number of images to run through the model at once')
+    workers: int = field(default=4, help='Number of threads decoding images ahead of the model')
+    prefetch: int = field(default=2, help='Number of batches to decode ahead of the model')
+    rethreshold: bool = field(default=False, help='Rebuild tags of all selected files from stored probabilities only')
+    no_store: bool = field(default=False, help='Neither read nor write stored probabilities')
+    ensemble: Optional[str] = field(default=None, help='Combine the probabilities of all models. mean or max')
+    fast_decode: bool = field(default=False, help='Decode large images near the input size of the model, faster with slightly different results, which are stored apart')
+    tensors: bool = field(default=False, help='Read and write preprocessed inputs in the tensor cache, see tensors build')
+    backend: str = field(default='eager', help='How to run the models. eager, compile, int8 or onnx. int8 and onnx run on the CPU')
+    threads: Optional[int] = field(default=None, help='Number of threads used within each operator of the model, one per core by default')
     def run(self, context :Context):
+        # the inference stack is heavy, load it when it is first used
+        from controllers.infer import infer_tags
+        from tqdm import tqdm
+        if self.rethreshold and self.no_store:
+            raise ValueError('Cannot rethreshold without stored probabilities')
         c = Captions(context)
-        files = [x.path for x in c.list(selected=True) if self.overwrite or self.append or x.tags is None or len(x.tags) == 0]
+        files = [x.path for x in c.list(selected=True) if self.rethreshold or self.overwrite or self.append or x.tags is None or len(x.tags) == 0]
         if len(files) == 0:
             return
-        progress = tqdm(infer_tags(files, models=self.model), total=len(files))
+        progress = tqdm(infer_tags(files,
+                                   models=self.model,
+                                   gen_threshold=self.gen,
+                                   char_threshold=self.char,
+                                   batch_size=self.batch_size,
+                                   workers=self.workers,
+                                   prefetch=self.prefetch,
+                                   cache=context.models,
+                                   store_path=None if self.no_store else context.cache_path/'probs',
+                                   rethreshold=self.rethreshold,
+                                   ensemble=self.ensemble,
+                                   fast_decode=self.fast_decode,
+                                   tensor_path=context.cache_path/'tensors' if self.tensors else None,
+                                   backend=self.backend,
+                                   threads=self.threads,
+                                   export_path=context.cache_path/'onnx'), total=len(files))
         progress.colour = 'green'
         for r in progress:
+            if r.error is not None:
+                progress.write(f'⚠ {r.path}: {r.error}')
+                continue
             if self.append:
                 c.append(r.path, r.tags)
             else:
@@ -76,8 +111,7 @@ class ReplaceTags:
     new :str = field(positional=True, hint='string to replace with', default='')
     def run(self, context :Context):
         c = TagsController(context)
-        count = c.replace(self.old, self.new)
-        print(f'{count} file{"s" if count>1 else ""} updated')
+        _report(c.replace(self.old, self.new))
 
 @dataclass
 class PruneTags:
@@ -87,7 +121,7 @@ class PruneTags:
     keep :List[str] = field(default=None, help='List of tags to keep')
     def run(self, context :Context):
         c = TagsController(context)
-        _, pruned = c.prune(self.min_length, 
+        result, pruned = c.prune(self.min_length, 
                         inclusion=self.inclusion,
                         character=self.character,
                         keep=self.keep)
@@ -99,6 +133,7 @@ class PruneTags:
             print(f'{len(pruned)} tags have been pruned:')
             for p in pruned:
                 print(p)
+        _report(result)
 
 @dataclass
 class DistanceTags:
@@ -111,13 +146,38 @@ class DistanceTags:
         for t1, t2, d in tags:
             print(f'{d:2d}, {t1}, {t2}')
 
+@dataclass
+class CooccurTags:
+    tag: str = field(positional=True, hint='Tag to look for')
+    head :int = field(default=20, help='Show only the top N tags, all if negative')
+    def run(self, context :Context):
+        c = TagsController(context)
+        items = c.cooccur(self.tag, head=self.head)
+        if len(items) == 0:
+            print(f'No tag appears with {self.tag}')
+        for i in items:
+            print(f'{i.count:4d} {i.confidence:6.1%} {i.reverse:6.1%} {i.tag}')
+
+@dataclass
+class ImpliedTags:
+    threshold :float = field(default=0.98, help='Minimum share of the files with a tag which also have the implied tag')
+    min_count :int = field(default=5, help='Minimum number of files with the tag')
+    def run(self, context :Context):
+        c = TagsController(context)
+        items = c.implied(threshold=self.threshold, min_count=self.min_count)
+        if len(items) == 0:
+            print('No implied tag found')
+        for i in items:
+            missing = f', missing in {i.missing} file{"s" if i.missing>1 else ""}' if i.missing else ''
+            print(f'{i.confidence:6.1%} {i.antecedent} => {i.consequent} ({i.support} files{missing})')
+
 @dataclass
 class OrderTags:
     tag: str = field(positional=True, hint='Tag to move')
     index: int = field(default=0, hint='Index to move the tag')
     def run(self, context :Context):
         c = TagsController(context)
-        c.order(self.tag, self.index)
+        _report(c.order(self.tag, self.index))
 
 @dataclass
 class Tags(ListTags):
@@ -130,7 +190,9 @@ class Tags(ListTags):
                                            'prune': PruneTags,
                                            'order': OrderTags,
                                            'verify': VerifyTags,
-                                           'distance': DistanceTags
+                                           'distance': DistanceTags,
+                                           'cooccur': CooccurTags,
+                                           'implied': ImpliedTags
                                            })
     def run(self, context :Context):
         if self.command:
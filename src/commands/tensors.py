@@ -0,0 +1,86 @@
+from typing import Any, List
+from dataclasses import dataclass
+import shutil
+from simple_parsing import field, subparsers
+from models.context import Context
+from controllers.captions import Captions
+
+def _megabytes(size: int) -> str:
+    return f'{size / 1024 / 1024:8.1f} MB'
+
+@dataclass
+class BuildTensors:
+    model :List[str] = field(default='vit', help='Models to preprocess the selected files for. vit, swinv2 or convnext')
+    batch_size :int = field(default=64, help='Number of images written to the cache at once')
+    workers :int = field(default=4, help='Number of threads decoding images')
+    fast_decode :bool = field(default=False, help='Decode large images near the input size of the model, as tags auto --fast_decode')
+    def run(self, context :Context):
+        # the inference stack is heavy, load it when it is first used
+        from controllers.infer import build_tensors
+        from tqdm import tqdm
+        files = [x.path for x in Captions(context).list(selected=True)]
+        if len(files) == 0:
+            return
+        progress = tqdm(build_tensors(files,
+                                      models=self.model,
+                                      tensor_path=context.cache_path/'tensors',
+                                      batch_size=self.batch_size,
+                                      workers=self.workers,
+                                      cache=context.models,
+                                      fast_decode=self.fast_decode), total=len(files))
+        progress.colour = 'green'
+        for r in progress:
+            if r.error is not None:
+                progress.write(f'⚠ {r.path}: {r.error}')
+
+@dataclass
+class StatusTensors:
+    def run(self, context :Context):
+        from models.tensors import list_stores
+        stores = list_stores(context.cache_path/'tensors', readonly=True)
+        total = 0
+        for store in stores:
+            size = store.nbytes
+            total += size
+            print(f'* {store.path.name} {len(store):8d} image{"s" if len(store)>1 else ""} {_megabytes(size)} {store.dtype.name}{list(store.shape)}')
+            print(f'  {store.description}')
+            store.close()
+        print(f'{_megabytes(total)} in {len(stores)} cache{"s" if len(stores)>1 else ""}')
+
+@dataclass
+class PruneTensors:
+    all :bool = field(default=False, help='Remove the whole cache instead of the images no longer in the dataset')
+    workers :int = field(default=4, help='Number of threads hashing files')
+    def run(self, context :Context):
+        # numpy is loaded on first use only
+        from models.probs import hash_files
+        from models.tensors import list_stores
+        path = context.cache_path/'tensors'
+        if self.all:
+            stores = list_stores(path, readonly=True)
+            for store in stores:
+                store.close()
+            shutil.rmtree(path, ignore_errors=True)
+            print(f'{len(stores)} cache{"s" if len(stores)>1 else ""} removed')
+            return
+        stores = list_stores(path)
+        if len(stores) == 0:
+            return
+        files = [x.path for x in Captions(context).list(selected=False)]
+        keep = set(h for h in hash_files(files, self.workers) if h is not None)
+        for store in stores:
+            before = store.nbytes
+            removed = store.prune(keep)
+            print(f'* {store.path.name} {removed} image{"s" if removed>1 else ""} removed, {_megabytes(before - store.nbytes).strip()} freed')
+            store.close()
+
+@dataclass
+class Tensors(StatusTensors):
+    command :Any = subparsers(default=None,
+                              subcommands={'build': BuildTensors,
+                                           'status': StatusTensors,
+                                           'prune': PruneTensors})
+    def run(self, context :Context):
+        if self.command:
+            return self.command.run(context)
+        return super().run(context)
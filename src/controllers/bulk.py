@@ -0,0 +1,103 @@
+from dataclasses import dataclass
+import sqlite3
+import time
+from typing import Dict, Iterable, Optional
+
+from models.context import Context
+from .transaction import Txn
+
+@dataclass
+class MutationResult:
+    files: int
+    rows: int
+    elapsed: float
+
+class Mutation:
+    '''
+    Apply a tag edit to many files with set-based SQL in a single transaction.
+    Files recorded with `touch` are marked as modified on exit when their tags
+    differ from their caption on disk, and the rows changed by `execute` are counted.
+    Only the files whose tags changed are counted in the result.
+
+        with Mutation.begin(context) as m:
+            m.touch("SELECT image_id FROM selected")
+            m.execute("DELETE FROM image_tags WHERE ...")
+        print(m.result)
+    '''
+    context: Context
+    cur: sqlite3.Cursor = None
+    rows: int = 0
+    result: Optional[MutationResult] = None
+    _txn: Txn = None
+    _start: float = 0.0
+    def __init__(self, context: Context) -> None:
+        self.context = context
+    @classmethod
+    def begin(cls, context: Context) -> 'Mutation':
+        return cls(context)
+    def __enter__(self) -> 'Mutation':
+        self._start = time.perf_counter()
+        self._txn = Txn.begin(self.context.conn)
+        self.cur = self._txn.__enter__()
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS affected (image_id INTEGER PRIMARY KEY, recorded INTEGER DEFAULT 0)")
+        self.cur.execute("DELETE FROM affected")
+        # tags of the affected files before the edit
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS affected_tags (image_id INTEGER, tag_id INTEGER, position INTEGER)")
+        self.cur.execute("DELETE FROM affected_tags")
+        self.context.dataset.journal.record(self.cur)
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        files = 0
+        if exc_type is None:
+            self.context.dataset._mark_dirty(self.cur, "SELECT image_id FROM affected")
+            files = self._changed()
+            self.context.dataset.journal.record(self.cur, False)
+        self._txn.__exit__(exc_type, exc_val, exc_tb)
+        self.result = MutationResult(files, self.rows, time.perf_counter() - self._start)
+    def touch(self, query: str, params: Iterable = ()) -> int:
+        '''
+        Record the image ids returned by the query as modified.
+        '''
+        self.cur.execute("INSERT OR IGNORE INTO affected (image_id) " + query, params)
+        count = self.cur.rowcount
+        self.cur.execute("INSERT INTO affected_tags (image_id, tag_id, position) " \
+                         "SELECT it.image_id, it.tag_id, it.position FROM affected as a, image_tags as it " \
+                         "WHERE a.recorded = 0 AND it.image_id = a.image_id")
+        self.cur.execute("UPDATE affected SET recorded = 1 WHERE recorded = 0")
+        return count
+    def _changed(self) -> int:
+        # files whose tag lists differ from before the edit, comparing the tags by rank rather than position
+        self.cur.execute("WITH " \
+                         "b AS (SELECT image_id, tag_id, ROW_NUMBER() OVER (PARTITION BY image_id ORDER BY position) as r FROM affected_tags), " \
+                         "n AS (SELECT it.image_id, it.tag_id, ROW_NUMBER() OVER (PARTITION BY it.image_id ORDER BY it.position) as r " \
+                         "FROM affected as a, image_tags as it WHERE it.image_id = a.image_id) " \
+                         "SELECT COUNT(*) FROM (SELECT image_id FROM (SELECT * FROM b EXCEPT SELECT * FROM n) " \
+                         "UNION SELECT image_id FROM (SELECT * FROM n EXCEPT SELECT * FROM b))")
+        return self.cur.fetchone()[0]
+    def execute(self, query: str, params: Iterable = ()) -> int:
+        self.cur.execute(query, params)
+        self.rows += max(self.cur.rowcount, 0)
+        return self.cur.rowcount
+    def tag_ids(self, names: Iterable[str]) -> Dict[str, int]:
+        '''
+        Return the ids of the names, adding unknown names to the vocabulary.
+        '''
+        return self.context.dataset._tag_ids(self.cur, names)
+    def find_tag_ids(self, names: Iterable[str]) -> Dict[str, int]:
+        '''
+        Return the ids of the names which are in the vocabulary.
+        '''
+        ids: Dict[str, int] = {}
+        for n in dict.fromkeys(names):
+            self.cur.execute("SELECT id FROM tags WHERE name = ?", (n, ))
+            row = self.cur.fetchone()
+            if row is not None:
+                ids[n] = row[0]
+        return ids
+    def target(self, tag_ids: Iterable[int]) -> None:
+        '''
+        Set the tag ids the edit applies to as the temporary table 'target_tags'.
+        '''
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS target_tags (tag_id INTEGER PRIMARY KEY)")
+        self.cur.execute("DELETE FROM target_tags")
+        self.cur.executemany("INSERT OR IGNORE INTO target_tags (tag_id) VALUES (?)", [(i, ) for i in tag_ids])
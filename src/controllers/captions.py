@@ -1,14 +1,20 @@
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 import json
 import logging
+import os
 from pathlib import Path
 import re
+import stat
+import time
 from typing import Dict, Iterable, List, Set
 
-from tqdm import tqdm
 from models.context import Context
+from .query import compile_query
 from .transaction import Txn
 
+SAVE_WORKERS = 16
+
 def load_caption(path: Path) -> Iterable[str]:
     with open(path, 'r') as f:
         for tag in re.split(",|\n|\r", f.read()):
@@ -26,95 +32,167 @@ class DiffResult:
     common: Set[str]
     dataset: Dict[str, List[str]]
 
+@dataclass
+class PendingItem:
+    path: Path
+    tags: List[str]
+    added: List[str]
+    removed: List[str]
+
+@dataclass
+class SaveResult:
+    pending: List[PendingItem]
+    saved: int = 0
+    failed: List[tuple[Path, Exception]] = field(default_factory=list)
+    elapsed: float = 0.0
+
+def _write_caption(path: Path, text: str) -> int:
+    # write next to the caption and rename over it, which is atomic on the same filesystem
+    temporary = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(temporary, "w") as f:
+            f.write(text)
+            # on disk before the rename, so that a crash never leaves an empty caption
+            f.flush()
+            os.fsync(f.fileno())
+        # keep the permissions of the caption replaced, the temporary file has those of the umask
+        try:
+            os.chmod(temporary, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(temporary, path)
+    except OSError:
+        temporary.unlink(missing_ok=True)
+        raise
+    return os.stat(path).st_mtime_ns
+
 class Captions:
     context: Context
     def __init__(self, context) -> None:
         self.context = context
     def select_all_files(self) -> int:
         return self.context.dataset._select_all_files()
-    def select_files(self, expr:List[str]) -> int:
-        paths: Set[str] = []
-        conditions: List[re.Pattern] = []
-        for e in expr:
-            conditions.append(re.compile(e))
+    def select_files(self, expr:List[str], query:str=None) -> int:
+        """
+        Select the files whose path matches any of the regular expressions
+        and whose tags satisfy the boolean query, such as `1girl AND (red hair OR blue hair) AND NOT solo`.
+        """
+        conditions = []
+        params = []
+        if expr:
+            conditions.append("(" + " OR ".join("path REGEXP ?" for _ in expr) + ")")
+            params += expr
+        if query is not None:
+            sql, query_params = compile_query(query)
+            conditions.append(f"id IN ({sql})")
+            params += query_params
         with Txn.begin(self.context.conn) as cur:
-            cur.execute("SELECT path FROM images")
-            for row in cur:
-                for c in conditions:
-                    if c.match(row[0]):
-                        paths.append(row[0])
-                        break
-            if len(paths) == 0:
-                raise ValueError("No files selected")
             cur.execute("DELETE FROM selected")
-            cur.executemany("INSERT INTO selected (path) VALUES (?)", [(x,) for x in paths])
-        return len(paths)
-    def save(self) -> int:
+            cur.execute("INSERT INTO selected (image_id) SELECT id FROM images " \
+                        f"WHERE {' AND '.join(conditions) if conditions else 1}", params)
+            count = cur.rowcount
+            if count == 0:
+                raise ValueError("No files selected")
+            self.context.dataset._count_selected(cur)
+        return count
+    def pending(self) -> List[PendingItem]:
+        """
+        Return the selected files modified since they were loaded or saved,
+        with the tags added and removed compared to the caption on disk.
+        """
+        with Txn.begin(self.context.conn) as cur:
+            rows = self.context.dataset._list_tags(cur, "SELECT s.image_id FROM selected as s, images as i " \
+                                                        "WHERE s.image_id = i.id AND i.dirty = 1")
+            items: List[PendingItem] = []
+            for _, path, tags in rows:
+                cur.execute("SELECT tags FROM idx.files WHERE path = ?", (path, ))
+                row = cur.fetchone()
+                saved = json.loads(row[0]) if row is not None else []
+                items.append(PendingItem(Path(path), tags,
+                                         [t for t in tags if t not in saved],
+                                         [t for t in saved if t not in tags]))
+        return items
+    def save(self, dry_run: bool = False) -> SaveResult:
+        """
+        Write the captions of the selected files modified since they were loaded or saved.
+        Each caption is written to a temporary file which then replaces the caption,
+        so an interrupted save never leaves a partially written caption.
+        """
+        start = time.perf_counter()
+        items = self.pending()
+        result = SaveResult(items)
+        if dry_run:
+            return result
+        saved: List[tuple[str, List[str], int]] = []
+        with ThreadPoolExecutor(max_workers=SAVE_WORKERS, thread_name_prefix='captions-save') as pool:
+            futures = [(i, pool.submit(_write_caption, i.path.with_suffix(".txt"), ", ".join(i.tags))) for i in items]
+            for i, f in futures:
+                try:
+                    saved.append((i.path.as_posix(), i.tags, f.result()))
+                except OSError as e:
+                    result.failed.append((i.path, e))
         with Txn.begin(self.context.conn) as cur:
-            cur.execute("SELECT i.path, JSON_EXTRACT(i.tags, '$') FROM images as i, selected as s WHERE i.path = s.path")
-            count = 0
-            for path, tags in cur:
-                with open(Path(path).with_suffix(".txt"), "w") as f:
-                    f.write(", ".join(json.loads(tags)))
-                count += 1
-            return count
+            self.context.dataset._mark_saved(cur, saved)
+        result.saved = len(saved)
+        result.elapsed = time.perf_counter() - start
+        return result
     def diff(self) -> DiffResult:
         with Txn.begin(self.context.conn) as cur:
             cur.execute("SELECT COUNT(*) FROM selected")
-            if cur.fetchone()[0] < 2:
+            selected = cur.fetchone()[0]
+            if selected < 2:
                 raise ValueError("Select at least two files")
-            cur.execute("SELECT i.path, JSON_EXTRACT(i.tags, '$') FROM images as i, selected as s WHERE i.path = s.path")
+            # tags found in every selected image, from the column sums of the selected rows
+            from models.matrix import selected_rows, tag_names
+            import numpy as np
+            rows = selected_rows(cur, self.context.dataset._tag_matrix(cur))
+            counts = np.asarray(rows.sum(axis=0)).ravel()
+            common: Set[str] = set(tag_names(cur, np.flatnonzero(counts == selected)))
             dataset: Dict[str, List[str]] = {}
-            path, tags = cur.fetchone()
-            v = json.loads(tags)
-            dataset[path] = v
-            common :Set[str] = set(v)
-            for path, tags in cur:
-                v = json.loads(tags)
-                dataset[path] = v
-                common &= set(v)
-            for k, v in dataset.items():
-                tag: List[str]= []
-                for t in v:
-                    if not t in common:
-                        tag.append(t)
-                dataset[k] = tag
+            for _, path, tags in self.context.dataset._list_tags(cur, "SELECT image_id FROM selected"):
+                dataset[path] = [t for t in tags if not t in common]
             return DiffResult(common, dataset)
     def list(self, selected:bool, filter:str=None) -> Iterable[FilesListItem]:
         with Txn.begin(self.context.conn) as cur:
-            query = ""
-            if selected:
-                query = "(" \
-                        "SELECT DISTINCT i.path as p FROM images as i, selected as s "
-                query += ", JSON_EACH(i.tags) as e " if filter is not None else " "
-                query += "WHERE i.path = s.path "
-                query += "AND e.VALUE LIKE ? " if filter is not None else " "
-                query += ") "
-            else:
-                query = "(" \
-                        "SELECT DISTINCT i.path as p FROM images as i "
-                query += ", JSON_EACH(i.tags) as e WHERE e.VALUE LIKE ? " if filter is not None else " "
-                query += ") "
-            query = "SELECT p, i.tags FROM " + query + " as v, images as i WHERE v.p = i.path " \
-                    "ORDER BY p ASC "
-            if filter:
-                cur.execute(query, ("%" if filter is None else "%"+filter+"%", ))
+            params = ()
+            if filter is not None:
+                # images having a tag which contains the filter
+                tags, params = self.context.dataset._tag_filter(filter)
+                query = f"SELECT DISTINCT it.image_id FROM image_tags as it WHERE it.tag_id IN ({tags})"
+                if selected:
+                    query += " AND it.image_id IN (SELECT image_id FROM selected)"
+            elif selected:
+                query = "SELECT image_id FROM selected"
             else:
-                cur.execute(query)
-            for path, tags in cur:
-                yield FilesListItem(Path(path), json.loads(tags))
+                query = "SELECT id as image_id FROM images"
+            rows = self.context.dataset._list_tags(cur, query, params)
+        for _, path, tags in rows:
+            yield FilesListItem(Path(path), tags)
     def relative(self, root_path: Path, absolute_path: Path) -> Path:
         root_as_posix = root_path.as_posix() + '/'
         absolute_as_posix = absolute_path.as_posix()
         if absolute_as_posix.startswith(root_as_posix):
             absolute_path = Path(absolute_as_posix[len(root_as_posix):])
         return absolute_path
+    def _image_id(self, cur, path: Path) -> int:
+        cur.execute("SELECT id FROM images WHERE path = ?", (path.as_posix(), ))
+        row = cur.fetchone()
+        if row is None:
+            raise KeyError(f"{path} is not in the dataset")
+        return row[0]
     def update(self, path: Path, tags: List[str]) -> None:
         with Txn.begin(self.context.conn) as cur:
-            cur.execute("UPDATE images SET tags = ? WHERE path = ?", (json.dumps(tags), path.as_posix()))
+            image_id = self._image_id(cur, path)
+            self.context.dataset.journal.record(cur)
+            self.context.dataset._set_tags(cur, image_id, tags)
+            self.context.dataset._mark_dirty(cur, "SELECT ?", (image_id, ))
+            self.context.dataset.journal.record(cur, False)
     def append(self, path: Path, tags: List[str]) -> None:
         with Txn.begin(self.context.conn) as cur:
-            cur.execute("SELECT tags FROM images WHERE path = ?", (path.as_posix(), ))
-            old_tags = json.loads(cur.fetchone()[0])
-            new_tags = list(set(old_tags) | set(tags))
-            cur.execute("UPDATE images SET tags = ? WHERE path = ?", (json.dumps(new_tags), path.as_posix()))
+            image_id = self._image_id(cur, path)
+            old_tags = self.context.dataset._get_tags(cur, image_id)
+            new_tags = old_tags + [t for t in dict.fromkeys(tags) if t not in old_tags]
+            self.context.dataset.journal.record(cur)
+            self.context.dataset._set_tags(cur, image_id, new_tags)
+            self.context.dataset._mark_dirty(cur, "SELECT ?", (image_id, ))
+            self.context.dataset.journal.record(cur, False)
@@ -0,0 +1,103 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import Levenshtein as levenshtein
+
+Q = 2
+# Pad both ends so that the first and the last characters appear in q q-grams
+_HEAD = '\x02' * (Q - 1)
+_TAIL = '\x03' * (Q - 1)
+# Below this number of tags, starting worker processes costs more than it saves
+_PARALLEL_MIN_TAGS = 2000
+
+class QGramIndex:
+    '''
+    Candidate index for pairs of strings within a Levenshtein distance.
+    Strings are sorted by length and their padded q-grams are kept in posting lists,
+    so a query only looks at strings of a close length sharing enough q-grams.
+    The index does not depend on the threshold and can be queried repeatedly.
+    '''
+    strings: List[str]
+    order: np.ndarray
+    lengths: np.ndarray
+    grams: List[Tuple[np.ndarray, np.ndarray]]
+    postings: Dict[int, Tuple[np.ndarray, np.ndarray]]
+    def __init__(self, strings: List[str]) -> None:
+        self.strings = strings
+        self.order = np.argsort(np.array([len(s) for s in strings], dtype=np.int64), kind='stable')
+        self.lengths = np.array([len(strings[i]) for i in self.order], dtype=np.int64)
+        ids: Dict[str, int] = {}
+        postings: Dict[int, Tuple[List[int], List[int]]] = {}
+        self.grams = []
+        for rank, i in enumerate(self.order):
+            padded = _HEAD + strings[i] + _TAIL
+            counts = Counter(padded[k:k + Q] for k in range(len(padded) - Q + 1))
+            gram_ids = np.array([ids.setdefault(g, len(ids)) for g in counts], dtype=np.int64)
+            gram_counts = np.array(list(counts.values()), dtype=np.int64)
+            self.grams.append((gram_ids, gram_counts))
+            for g, c in zip(gram_ids, gram_counts):
+                ranks, cs = postings.setdefault(int(g), ([], []))
+                ranks.append(rank)
+                cs.append(c)
+        # ranks in each posting list are ascending, so a length window is a slice
+        self.postings = {g: (np.array(r, dtype=np.int64), np.array(c, dtype=np.int64)) for g, (r, c) in postings.items()}
+    def __len__(self) -> int:
+        return len(self.strings)
+    def _candidates(self, rank: int, threshold: int) -> np.ndarray:
+        # strings after `rank` whose length differs by at most the threshold
+        end = int(np.searchsorted(self.lengths, self.lengths[rank] + threshold, side='right'))
+        if end <= rank + 1:
+            return np.empty(0, dtype=np.int64)
+        # count q-grams shared with each string in the window, as multisets
+        others: List[np.ndarray] = []
+        weights: List[np.ndarray] = []
+        gram_ids, gram_counts = self.grams[rank]
+        for g, c in zip(gram_ids, gram_counts):
+            ranks, counts = self.postings[int(g)]
+            lo, hi = np.searchsorted(ranks, [rank + 1, end])
+            others.append(ranks[lo:hi])
+            weights.append(np.minimum(counts[lo:hi], c))
+        shared = np.bincount(np.concatenate(others) - rank - 1, weights=np.concatenate(weights), minlength=end - rank - 1)
+        # each edit destroys at most q of the padded q-grams
+        longest = np.maximum(self.lengths[rank + 1:end], self.lengths[rank])
+        bound = longest + Q - 1 - threshold * Q
+        return np.flatnonzero(shared >= bound) + rank + 1
+    def _verify(self, ranks: range, threshold: int) -> List[Tuple[int, int, int]]:
+        pairs: List[Tuple[int, int, int]] = []
+        for rank in ranks:
+            a = int(self.order[rank])
+            for other in self._candidates(rank, threshold):
+                b = int(self.order[other])
+                d = levenshtein.distance(self.strings[a], self.strings[b])
+                if d <= threshold:
+                    pairs.append((min(a, b), max(a, b), d))
+        return pairs
+    def pairs(self, threshold: int, workers: Optional[int] = None) -> List[Tuple[int, int, int]]:
+        '''
+        Return every pair of string indices (i, j, distance) with i < j and distance <= threshold,
+        sorted by i then j.
+        '''
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(self) < _PARALLEL_MIN_TAGS:
+            pairs = self._verify(range(len(self)), threshold)
+        else:
+            # interleave ranks so that every worker gets short and long strings alike
+            chunks = [range(k, len(self), workers * 4) for k in range(workers * 4)]
+            pairs = []
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self, )) as pool:
+                for p in pool.map(_verify_in_worker, chunks, [threshold] * len(chunks)):
+                    pairs.extend(p)
+        pairs.sort()
+        return pairs
+
+_worker_index: Optional[QGramIndex] = None
+
+def _init_worker(index: QGramIndex) -> None:
+    global _worker_index
+    _worker_index = index
+
+def _verify_in_worker(ranks: range, threshold: int) -> List[Tuple[int, int, int]]:
+    return _worker_index._verify(ranks, threshold)
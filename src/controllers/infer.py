@@ -1,19 +1,34 @@
+import inspect
 import logging
+import warnings
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Callable, Iterable, List, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 from dataclasses import dataclass
 from simple_parsing import field, parse_known_args
 from PIL import Image
 from torch import Tensor, nn
 import numpy as np
-import os
-import tomllib as toml
+from models.cache import LruCache
+from models.config import model_repo_map
+from models.probs import PROBS_DTYPE, ProbabilityStore, hash_files
+from models.tensors import TensorStore, config_key
 
-config_path = os.path.join('assets/config.tom')
-with open(config_path, 'rb') as f:
-    config = toml.load(f)
+# ways to run a model, see get_backend
+BACKENDS = ['eager', 'compile', 'int8', 'onnx']
 
-MODEL_REPO_MAP = config['MODELS']
+ENSEMBLE_METHODS: dict[str, Callable[[List[np.ndarray]], np.ndarray]] = {
+    'mean': lambda probs: np.mean(probs, axis=0),
+    'max': lambda probs: np.max(probs, axis=0),
+}
+
+# version of the preprocessed inputs in the tensor cache, to change when they are computed differently
+TENSOR_FORMAT = 1
+
+# images decoded at reduced resolution stay this many times larger than the input of the model,
+# leaving the final antialiasing to the resize of the transform
+REDUCE_MARGIN = 2
 
 def pil_ensure_rgb(image: Image.Image) -> Image.Image:
     # convert to RGB/RGBA if not already (deals with palette images etc.)
@@ -38,9 +53,19 @@ def pil_pad_square(image: Image.Image) -> Image.Image:
 @dataclass
 class LabelData:
     names: list[str]
-    rating: list[np.int64]
-    general: list[np.int64]
-    character: list[np.int64]
+    rating: np.ndarray
+    general: np.ndarray
+    character: np.ndarray
+    captions: np.ndarray = None
+    def __post_init__(self):
+        self.rating = np.asarray(self.rating, dtype=np.int64)
+        self.general = np.asarray(self.general, dtype=np.int64)
+        self.character = np.asarray(self.character, dtype=np.int64)
+        if self.captions is None:
+            # general labels use spaces, and parentheses are escaped for training captions
+            names = np.array(self.names, dtype=object)
+            names[self.general] = [x.replace('_', ' ') for x in names[self.general]]
+            self.captions = np.array([x.replace('(', '\\(').replace(')', '\\)').strip() for x in names], dtype=object)
 
 def _load_labels(
     repo_id: str,
@@ -61,134 +86,680 @@ def _load_labels(
     df: pd.DataFrame = pd.read_csv(csv_path, usecols=['name', 'category'])
     tag_data = LabelData(
         names=df['name'].tolist(),
-        rating=list(np.where(df['category'] == 9)[0]),
-        general=list(np.where(df['category'] == 0)[0]),
-        character=list(np.where(df['category'] == 4)[0]),
+        rating=np.where(df['category'] == 9)[0],
+        general=np.where(df['category'] == 0)[0],
+        character=np.where(df['category'] == 4)[0],
     )
     return tag_data
 
+def _select_labels(probs: np.ndarray, index: np.ndarray, threshold: float) -> List[np.ndarray]:
+    # pick labels where prediction confidence > threshold, sorted by confidence
+    probs = probs[:, index]
+    selected: List[np.ndarray] = []
+    for row, mask in zip(probs, probs > threshold):
+        hit = np.flatnonzero(mask)
+        selected.append(index[hit[np.argsort(-row[hit], kind='stable')]])
+    return selected
+
 def _get_tags(
-    probs: Tensor,
+    probs: np.ndarray,
     labels: LabelData,
     gen_threshold: float,
     char_threshold: float,
-):
-    # Convert indices+probs to labels
-    probs = list(zip(labels.names, probs.numpy()))
+) -> List[List[str]]:
+    # probs is a (batch, labels) array; returns one caption per row
+    char_labels = _select_labels(probs, labels.character, char_threshold)
+    gen_labels = _select_labels(probs, labels.general, gen_threshold)
+    captions: List[List[str]] = []
+    for c, g in zip(char_labels, gen_labels):
+        # character labels first, then general labels
+        caption = labels.captions[np.concatenate([c, g])].tolist()
+        # an image without tags keeps the single empty tag of a joined caption
+        captions.append(caption if len(caption) > 0 else [''])
+    return captions
 
-    # First 4 labels are actually ratings
-    rating_labels = dict([probs[i] for i in labels.rating])
+def pil_open_reduced(image_path: Path, size: int) -> Image.Image:
+    """
+    Open an image decoded close to `size` times REDUCE_MARGIN on its longest side, never below.
+    JPEG files are decoded with DCT scaling without reading the full resolution,
+    other formats are shrunk right after decoding by averaging blocks of pixels.
+    """
+    image: Image.Image = Image.open(image_path)
+    target = size * REDUCE_MARGIN
+    longest = max(image.size)
+    if longest <= target:
+        return image
+    if image.format == 'JPEG':
+        # draft picks the largest scale of 1/2, 1/4 or 1/8 which is still at least the requested size
+        image.draft('RGB', (-(-image.width * target // longest), -(-image.height * target // longest)))
+    if image.mode not in ['RGB', 'RGBA']:
+        image = image.convert('RGBA') if 'transparency' in image.info else image.convert('RGB')
+    factor = max(image.size) // target
+    if factor > 1:
+        if image.mode == 'RGBA':
+            # average premultiplied colors so that transparent pixels do not bleed into the edges
+            image = image.convert('RGBa').reduce(factor).convert('RGBA')
+        else:
+            image = image.reduce(factor)
+    return image
 
-    # General labels, pick any where prediction confidence > threshold
-    gen_labels = [probs[i] for i in labels.general]
-    gen_labels = dict([x for x in gen_labels if x[1] > gen_threshold])
-    gen_labels = dict(sorted(gen_labels.items(), key=lambda item: item[1], reverse=True))
+def _input_size(transform: Callable) -> Optional[int]:
+    # the side of the square the transform resizes images to, None when it does not resize
+    from torchvision.transforms import Resize
+    for t in getattr(transform, 'transforms', []):
+        if isinstance(t, Resize):
+            return t.size if isinstance(t.size, int) else max(t.size)
+    return None
 
-    # Character labels, pick any where prediction confidence > threshold
-    char_labels = [probs[i] for i in labels.character]
-    char_labels = dict([x for x in char_labels if x[1] > char_threshold])
-    char_labels = dict(sorted(char_labels.items(), key=lambda item: item[1], reverse=True))
+def _decode_image(image_path: Path, size: Optional[int] = None) -> Image.Image:
+    # get image, at reduced resolution when the size of the model input is given
+    img_input: Image.Image = Image.open(image_path) if size is None else pil_open_reduced(image_path, size)
+    # ensure image is RGB
+    img_input = pil_ensure_rgb(img_input)
+    # pad to square with white background
+    return pil_pad_square(img_input)
 
-    # Combine general and character labels, sort by confidence
-    combined_names = [x for x in char_labels]
-    combined_names.extend([x.replace('_', ' ') for x in gen_labels])
+def _transform_image(image: Image.Image, transform: Callable) -> Tensor:
+    # run the model's input transform to convert to tensor and rescale
+    inputs: Tensor = transform(image)
+    # CHW image RGB to BGR
+    return inputs[[2, 1, 0]]
 
-    # Convert to a string suitable for use as a training caption
-    tags = ','.join(combined_names)
-    taglist = tags.replace('(', '\\(').replace(')', '\\)')
-    return taglist.split(','), taglist, rating_labels, char_labels, gen_labels
+def _load_image(image_path: Path, transform: Callable, size: Optional[int] = None) -> Tensor:
+    return _transform_image(_decode_image(image_path, size), transform)
 
+def _load_images(image_path: Path, transforms: List[Callable], size: Optional[int] = None) -> List[Tensor]:
+    # decode once and prepare the input of every model
+    image = _decode_image(image_path, size)
+    return [_transform_image(image, t) for t in transforms]
 
-def _process_one(image_path: Path, 
-                 gen_threshold: float, char_threshold: float, 
-                 model: nn.Module, labels: LabelData, transform: Callable, device) -> List[str]:
+@dataclass
+class Preprocess:
+    """
+    The transform of a model split at the point its output is cached.
+    `stage` turns a decoded image into the array kept in the tensor cache, and
+    `finish` turns a batch of them into the input of the model.
+    """
+    description: str
+    shape: tuple
+    dtype: np.dtype
+    stage: Callable[[Image.Image], np.ndarray]
+    finish: Callable[[Tensor], Tensor]
+
+def _fixed_size(steps: List[Callable]) -> Optional[Tuple[int, int]]:
+    # the height and width of the images the resizing steps output whatever the input, None when they vary
+    size = None
+    for t in steps:
+        name = type(t).__name__
+        side = getattr(t, 'size', None)
+        side = (side, side) if isinstance(side, int) else tuple(side) if isinstance(side, (tuple, list)) else None
+        if 'Crop' in name:
+            size = side if side is not None and len(side) == 2 else None
+        elif 'Resize' in name:
+            # resizing the shorter side to an int keeps the aspect ratio of the input
+            size = side if isinstance(t.size, (tuple, list)) and len(side) == 2 else None
+    return size
+
+def _preprocess(transform: Callable, size: Optional[int]) -> Optional[Preprocess]:
+    """
+    How the inputs of a model are staged in the tensor cache,
+    None when the transform does not give inputs of a fixed shape.
+    """
+    import torch
+    from torchvision.transforms import Compose, Normalize, ToTensor
+    transform_text = ' '.join(repr(transform).split())
+    description = f'format={TENSOR_FORMAT} reduce={None if size is None else size * REDUCE_MARGIN} {transform_text}'
+    steps = list(getattr(transform, 'transforms', []))
+    split = next((i for i, t in enumerate(steps) if isinstance(t, ToTensor)), None)
+    fixed = None if split is None else _fixed_size(steps[:split])
+    if fixed is None:
+        return None
+    rest = steps[split + 1:]
+    if all(isinstance(t, Normalize) for t in rest):
+        # resized pixels are stored as uint8, scaling and normalization are cheap on a whole batch
+        resize = Compose(steps[:split])
+        stage = lambda image: np.ascontiguousarray(np.asarray(resize(image), dtype=np.uint8).transpose(2, 0, 1))
+        def finish(batch: Tensor) -> Tensor:
+            inputs = batch.float().div_(255)
+            for t in rest:
+                mean = torch.as_tensor(t.mean, dtype=inputs.dtype).view(-1, 1, 1)
+                std = torch.as_tensor(t.std, dtype=inputs.dtype).view(-1, 1, 1)
+                inputs = inputs.sub_(mean).div_(std)
+            # NCHW images RGB to BGR
+            return inputs[:, [2, 1, 0]]
+        dtype = np.uint8
+    else:
+        # other steps after ToTensor are cached applied, in full precision so that cached inputs give the same probabilities
+        stage = lambda image: _transform_image(image, transform).numpy().astype(np.float32)
+        finish = lambda batch: batch
+        dtype = np.float32
+    # the steps after ToTensor keep the size, only the channels and the dtype are left to find
+    shape = stage(Image.new('RGB', fixed[::-1], (255, 255, 255))).shape
+    if tuple(shape[1:]) != fixed:
+        return None
+    return Preprocess(description, shape, np.dtype(dtype), stage, finish)
+
+def _load_staged(image_path: Path, digest: Optional[str], preprocess: List[Preprocess],
+                 stores: List[TensorStore], rows: List[Dict[str, int]], size: Optional[int]) -> List[Tensor]:
+    import torch
+    # inputs found in the cache are views of its memory maps, the others are decoded
+    if digest is not None and all(digest in r for r in rows):
+        return [torch.from_numpy(s.view(r[digest])) for s, r in zip(stores, rows)]
+    image = _decode_image(image_path, size)
+    return [torch.from_numpy(p.stage(image)) for p in preprocess]
+
+def _write_staged(files: List[Path], inputs: List[List[Tensor]], digest: Dict[Path, Optional[str]],
+                  stores: List[TensorStore], rows: List[Dict[str, int]]) -> None:
+    # add the decoded inputs to the cache, and to the rows found so that duplicates are written once
+    for k, store in enumerate(stores):
+        miss = [i for i, f in enumerate(files) if digest[f] is not None and digest[f] not in rows[k]]
+        if len(miss) == 0:
+            continue
+        staged: Dict[str, np.ndarray] = {}
+        for i in miss:
+            staged.setdefault(digest[files[i]], inputs[i][k].numpy())
+        start = len(store)
+        store.write(list(staged), np.stack(list(staged.values())))
+        rows[k].update((h, start + j) for j, h in enumerate(staged))
+
+def _open_tensor_stores(tensor_path: Path, preprocess: List[Preprocess]) -> List[TensorStore]:
+    return [TensorStore(tensor_path/config_key(p.description), p.shape, p.dtype, p.description) for p in preprocess]
+
+def _predict(inputs: Tensor, model: Callable[[Tensor], Tensor], device) -> np.ndarray:
     import torch
     from torch.nn import functional as F
     log = logging.getLogger(__name__)
-    # get image
-    img_input: Image.Image = Image.open(image_path)
-    # ensure image is RGB
-    img_input = pil_ensure_rgb(img_input)
-    # pad to square with white background
-    img_input = pil_pad_square(img_input)
-    # run the model's input transform to convert to tensor and rescale
-    inputs: Tensor = transform(img_input).unsqueeze(0)
-    # NCHW image RGB to BGR
-    inputs = inputs[:, [2, 1, 0]]
 
-    log.info('Running inference...')
+    log.info(f'Running inference on {inputs.shape[0]} images...')
     with torch.inference_mode():
         # move model to GPU, if available
         if device.type != 'cpu':
             inputs = inputs.to(device)
         # run the model
-        outputs = model.forward(inputs)
+        outputs = model(inputs)
         # apply the final activation function (timm doesn't support doing this internally)
         outputs = F.sigmoid(outputs)
         # move inputs, outputs, and model back to to cpu if we were on GPU
         if device.type != 'cpu':
             inputs = inputs.to('cpu')
             outputs = outputs.to('cpu')
+    return outputs.numpy()
 
-    log.info('Processing results...')
-    caption, _, _, _, _ = _get_tags(
-        probs=outputs.squeeze(0),
-        labels=labels,
-        gen_threshold=gen_threshold,
-        char_threshold=char_threshold,
-    )
-    return [x.strip() for x in caption]
+def _process_one(image_path: Path, 
+                 gen_threshold: float, char_threshold: float, 
+                 model: nn.Module, labels: LabelData, transform: Callable, device) -> List[str]:
+    inputs = _load_image(image_path, transform).unsqueeze(0)
+    probs = _predict(inputs, model, device)
+    return _get_tags(probs, labels, gen_threshold, char_threshold)[0]
+
+def _batched(files: List[Path], batch_size: int) -> Iterable[List[Path]]:
+    for i in range(0, len(files), batch_size):
+        yield files[i:i + batch_size]
+
+def _prefetch(files: List[Path], load: Callable[[Path], List[Tensor]],
+              batch_size: int, workers: int, prefetch: int) -> Iterable[List[tuple[Path, Future]]]:
+    # load the inputs of images on a thread pool ahead of the model,
+    # keeping at most `prefetch` batches queued beyond the one being consumed
+    pending: deque[List[tuple[Path, Future]]] = deque()
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='infer-load')
+    try:
+        for batch in _batched(files, batch_size):
+            pending.append([(f, pool.submit(load, f)) for f in batch])
+            if len(pending) > prefetch:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+@dataclass
+class TaggerModel:
+    name: str
+    repo_id: str
+    model: nn.Module
+    labels: LabelData
+    transform: Callable
+    # callables prepared from the model by backend, see get_backend
+    backends: Dict[str, Callable[[Tensor], Tensor]] = None
+    def __post_init__(self):
+        if self.backends is None:
+            self.backends = {}
+    @property
+    def nbytes(self) -> int:
+        tensors = list(self.model.parameters()) + list(self.model.buffers())
+        # the weights of the prepared backends which are not shared with the model
+        return sum(t.numel() * t.element_size() for t in tensors) + \
+               sum(_runner_nbytes(r, self.model) for r in self.backends.values())
+
+def _runner_nbytes(runner: Callable[[Tensor], Tensor], model: nn.Module) -> int:
+    if runner is model or getattr(runner, '_orig_mod', None) is model:
+        return 0
+    if isinstance(runner, OnnxModel):
+        return runner.nbytes
+    # a quantized copy keeps its packed weights in tuples of its state dict
+    pending = list(runner.state_dict().values())
+    size = 0
+    while pending:
+        value = pending.pop()
+        if isinstance(value, (tuple, list)):
+            pending.extend(value)
+        elif isinstance(value, Tensor):
+            size += value.numel() * value.element_size()
+    return size
+
+def load_model(name: str) -> TaggerModel:
+    import timm
+    from timm.data import create_transform, resolve_data_config
+
+    # Check if the provided model is expected
+    repo_map = model_repo_map()
+    if name not in repo_map:
+        raise ValueError(f'Unknown model "{name}". Available models: {list(repo_map.keys())}')
+    repo_id = repo_map.get(name)
+
+    log = logging.getLogger(__name__)
+    log.info(f'Loading model "{name}" from "{repo_id}"...')
+    m: nn.Module = timm.create_model('hf-hub:' + repo_id).eval()
+    state_dict = timm.models.load_state_dict_from_hf(repo_id)
+    m.load_state_dict(state_dict)
+
+    log.info('Loading tag list...')
+    labels: LabelData = _load_labels(repo_id=repo_id)
+
+    log.info('Creating data transform...')
+    transform = create_transform(**resolve_data_config(m.pretrained_cfg, model=name))
+    return TaggerModel(name, repo_id, m, labels, transform)
+
+def get_transform(name: str, cache: Optional[LruCache[TaggerModel]] = None) -> Callable:
+    # the preprocessing alone comes from the model config, without loading the weights
+    tagger = cache.get(name) if cache is not None else None
+    if tagger is not None:
+        return tagger.transform
+    import timm
+    from timm.data import create_transform, resolve_data_config
+    pretrained_cfg, model_name, _ = timm.models.load_model_config_from_hf(model_repo_map()[name])
+    # completed with the defaults as timm.create_model does, so that the transform is the same as load_model's
+    pretrained_cfg = timm.models.resolve_pretrained_cfg(model_name, pretrained_cfg=pretrained_cfg).to_dict()
+    return create_transform(**resolve_data_config(pretrained_cfg, model=name))
+
+def get_labels(name: str, cache: Optional[LruCache[TaggerModel]] = None) -> LabelData:
+    # the tag list alone is enough when no inference is needed
+    tagger = cache.get(name) if cache is not None else None
+    if tagger is not None:
+        return tagger.labels
+    return _load_labels(repo_id=model_repo_map()[name])
+
+def get_model(name: str, cache: Optional[LruCache[TaggerModel]] = None) -> TaggerModel:
+    if cache is None:
+        return load_model(name)
+    tagger = cache.get(name)
+    if tagger is None:
+        tagger = load_model(name)
+        cache.put(name, tagger, tagger.nbytes)
+    return tagger
+
+class OnnxModel:
+    """
+    A model exported to ONNX, run by ONNX Runtime on the CPU.
+    """
+    def __init__(self, path: Path, threads: Optional[int] = None) -> None:
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        # 0 lets ONNX Runtime use one thread per physical core
+        options.intra_op_num_threads = threads or 0
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0].name
+        # the session holds the weights of the export
+        self.nbytes = path.stat().st_size
+    def __call__(self, inputs: Tensor) -> Tensor:
+        import torch
+        outputs = self.session.run(None, {self.input: inputs.contiguous().numpy()})[0]
+        return torch.from_numpy(outputs)
+
+def _fingerprint(model: nn.Module) -> str:
+    # changes with the architecture and the weights, without hashing every byte of them
+    import hashlib
+    import torch
+    digest = hashlib.blake2b(digest_size=8)
+    with torch.no_grad():
+        for name, t in model.state_dict().items():
+            digest.update(f'{name}{tuple(t.shape)}{t.double().sum().item() if t.is_floating_point() else 0}'.encode())
+    return digest.hexdigest()
+
+def export_onnx(tagger: TaggerModel, export_path: Path) -> Path:
+    """
+    Export the model to ONNX with a dynamic batch size, once per architecture and weights.
+    """
+    import torch
+    log = logging.getLogger(__name__)
+    path = export_path/f'{tagger.repo_id.replace("/", "--")}-{_fingerprint(tagger.model)}.onnx'
+    if path.exists():
+        return path
+    export_path.mkdir(parents=True, exist_ok=True)
+    log.info(f'Exporting model "{tagger.name}" to "{path}"...')
+    shape = tagger.model.pretrained_cfg.get('input_size', (3, 224, 224))
+    partial = path.with_suffix('.partial')
+    # the TorchScript exporter, which recent versions no longer default to and older ones have no option for
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad(), warnings.catch_warnings():
+        # tracing warns about the shape checks of the model, which hold for any batch size
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        torch.onnx.export(tagger.model, (torch.zeros((2, ) + tuple(shape)), ), str(partial),
+                          input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}}, **options)
+    partial.replace(path)
+    return path
+
+def get_backend(tagger: TaggerModel, backend: str = 'eager', threads: Optional[int] = None,
+                export_path: Optional[Path] = None, cache: Optional[LruCache[TaggerModel]] = None) -> Callable[[Tensor], Tensor]:
+    """
+    Return a callable running the model with the backend, prepared once per model.
+    'compile' runs the model through torch.compile, 'int8' with the weights of its
+    linear layers dynamically quantized to int8, and 'onnx' through ONNX Runtime
+    from an export kept in `export_path`. The size of the model in the cache
+    is updated with the memory of the backend.
+    """
+    import torch
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend "{backend}". Available backends: {BACKENDS}')
+    # the thread count is fixed when an ONNX Runtime session is created
+    key = f'{backend}:{threads or 0}' if backend == 'onnx' else backend
+    runner = tagger.backends.get(key)
+    if runner is not None:
+        return runner
+    if backend == 'eager':
+        runner = tagger.model
+    elif backend == 'compile':
+        runner = torch.compile(tagger.model)
+    elif backend == 'int8':
+        # the classifier maps to thousands of labels near their thresholds, keep it in float
+        spec = {nn.Linear: torch.ao.quantization.per_channel_dynamic_qconfig}
+        classifier = getattr(tagger.model, 'pretrained_cfg', {}).get('classifier')
+        if classifier is not None:
+            spec[classifier] = None
+        runner = torch.ao.quantization.quantize_dynamic(tagger.model, spec, dtype=torch.qint8)
+    else:
+        if export_path is None:
+            raise ValueError('The onnx backend needs a path to export the model to')
+        runner = OnnxModel(export_onnx(tagger, export_path), threads)
+    tagger.backends[key] = runner
+    if cache is not None and cache.get(tagger.name) is tagger:
+        cache.put(tagger.name, tagger, tagger.nbytes)
+    return runner
 
 @dataclass
 class InferTagsResult:
     path: Path
     tags: List[str]
+    error: Optional[Exception] = None
 
-def infer_tags(files: List[str],
-               models: List[str]=["vit"], 
-               gen_threshold: float = 0.35,
-               char_threshold: float = 0.75
-               ) -> Iterable[InferTagsResult]:
-    import timm
+def _decode_size(transforms: List[Callable], fast_decode: bool) -> Optional[int]:
+    # decode for the largest input, unless a model does not resize
+    if not fast_decode:
+        return None
+    sizes = [_input_size(t) for t in transforms]
+    return None if None in sizes else max(sizes)
+
+def _infer(files: List[Path],
+           hashes: Optional[List[Optional[str]]],
+           models: List[str],
+           combine: Callable[[List[np.ndarray]], np.ndarray],
+           gen_threshold: float,
+           char_threshold: float,
+           batch_size: int,
+           workers: int,
+           prefetch: int,
+           cache: Optional[LruCache[TaggerModel]],
+           store_path: Optional[Path],
+           rethreshold: bool,
+           fast_decode: bool,
+           tensor_path: Optional[Path],
+           backend: str,
+           threads: Optional[int],
+           export_path: Optional[Path],
+           device) -> Iterable[InferTagsResult]:
+    # tag files with the combined probabilities of the models, decoding each image once
     import torch
-    from timm.data import create_transform, resolve_data_config
-    import os
-    from tqdm import tqdm
+    log = logging.getLogger(__name__)
 
-    # Check if the provided model is expected
-    for model in models:
-        if model not in MODEL_REPO_MAP:
-            raise ValueError(f'Unknown model "{model}". Available models: {list(MODEL_REPO_MAP.keys())}')
+    labels = get_labels(models[0], cache)
+    for model in models[1:]:
+        if get_labels(model, cache).names != labels.names:
+            raise ValueError(f'Models "{models[0]}" and "{model}" have different tag lists')
 
-    # Use GPU if available
-    torch_device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    stores: List[ProbabilityStore] = []
+    tensor_stores: List[TensorStore] = []
+    taggers: List[TaggerModel] = []
+    digest: Dict[Path, Optional[str]] = dict(zip(files, hashes)) if hashes is not None else {}
+    known = [h for h in digest.values() if h is not None]
+    try:
+        targets = files
+        if store_path is not None:
+            # fast decoding and quantized models give slightly different probabilities, which are stored apart
+            suffix = ('@fast' if fast_decode else '') + ('@int8' if backend == 'int8' else '')
+            stores = [ProbabilityStore(store_path/(model_repo_map()[m].replace('/', '--') + suffix), len(labels.names)) for m in models]
+            found = [store.find(known) for store in stores]
+            # build captions from stored probabilities without running the models
+            cached = [f for f in files if all(digest[f] in rows for rows in found)]
+            log.info(f'{len(cached)} of {len(files)} images have stored probabilities')
+            for batch in _batched(cached, max(batch_size, 256)):
+                probs = combine([store.read([rows[digest[f]] for f in batch]) for store, rows in zip(stores, found)])
+                captions = _get_tags(probs, labels, gen_threshold, char_threshold)
+                for file, caption in zip(batch, captions):
+                    yield InferTagsResult(path=file, tags=caption)
+            cached = set(cached)
+            targets = [f for f in files if f not in cached]
+            if rethreshold:
+                for file in targets:
+                    yield InferTagsResult(path=file, tags=None,
+                                          error=LookupError(f'No stored probabilities for {", ".join(models)}'))
+                return
+            if len(targets) == 0:
+                return
+
+        # Load the models
+        taggers = [get_model(m, cache) for m in models]
+        if device.type != 'cpu':
+            for t in taggers:
+                t.model.to(device)
+        runners = [get_backend(t, backend, threads, export_path, cache) for t in taggers]
 
-    # Load the model
+        size = _decode_size([t.transform for t in taggers], fast_decode)
+        preprocess: List[Preprocess] = []
+        if tensor_path is not None:
+            preprocess = [_preprocess(t.transform, size) for t in taggers]
+            if any(p is None for p in preprocess):
+                uncached = [t.name for t, p in zip(taggers, preprocess) if p is None]
+                log.warning(f'Inputs of {", ".join(uncached)} have no fixed shape, not using the tensor cache')
+                tensor_path, preprocess = None, []
+        if tensor_path is not None:
+            tensor_stores = _open_tensor_stores(tensor_path, preprocess)
+            tensor_rows = [store.find(known) for store in tensor_stores]
+            log.info(f'{sum(digest[f] is not None and all(digest[f] in r for r in tensor_rows) for f in targets)} ' \
+                     f'of {len(targets)} images have cached inputs')
+            load = lambda f: _load_staged(f, digest[f], preprocess, tensor_stores, tensor_rows, size)
+        else:
+            transforms = [t.transform for t in taggers]
+            load = lambda f: _load_images(f, transforms, size)
+        def stack(inputs: List[List[Tensor]], k: int, indices: Iterable[int]) -> Tensor:
+            batch = torch.stack([inputs[i][k] for i in indices])
+            return batch if len(preprocess) == 0 else preprocess[k].finish(batch)
+
+        for batch in _prefetch(targets, load, batch_size, workers, prefetch):
+            # collect one by one so that a broken file is reported alone
+            inputs: List[List[Tensor]] = []
+            loaded: List[Path] = []
+            for file, future in batch:
+                try:
+                    inputs.append(future.result())
+                    loaded.append(file)
+                except Exception as e:
+                    log.warning(f'Failed to load "{file}": {e}')
+                    yield InferTagsResult(path=file, tags=None, error=e)
+            if len(inputs) == 0:
+                continue
+            if len(tensor_stores) > 0:
+                _write_staged(loaded, inputs, digest, tensor_stores, tensor_rows)
+            probs: List[np.ndarray] = []
+            for k, tagger in enumerate(taggers):
+                if len(stores) == 0:
+                    probs.append(_predict(stack(inputs, k, range(len(inputs))), runners[k], device))
+                    continue
+                # run the model only on images it has no stored probabilities for
+                p = np.empty((len(loaded), len(labels.names)), dtype=np.float32)
+                hit = [i for i, f in enumerate(loaded) if digest[f] in found[k]]
+                miss = [i for i, f in enumerate(loaded) if digest[f] not in found[k]]
+                if len(hit) > 0:
+                    p[hit] = stores[k].read([found[k][digest[loaded[i]]] for i in hit])
+                if len(miss) > 0:
+                    # round as stored so that rethresholding gives the same tags later
+                    p[miss] = _predict(stack(inputs, k, miss), runners[k], device).astype(PROBS_DTYPE)
+                    keep = [i for i in miss if digest[loaded[i]] is not None]
+                    stores[k].write([digest[loaded[i]] for i in keep], p[keep])
+                probs.append(p)
+            captions = _get_tags(combine(probs), labels, gen_threshold, char_threshold)
+            for file, caption in zip(loaded, captions):
+                yield InferTagsResult(path=file, tags=caption)
+    finally:
+        # move models back to cpu if we were on GPU
+        if device.type != 'cpu':
+            for t in taggers:
+                t.model.to('cpu')
+        for store in stores + tensor_stores:
+            store.close()
+
+def build_tensors(files: List[str],
+                  models: List[str] = ["vit"],
+                  tensor_path: Path = None,
+                  batch_size: int = 64,
+                  workers: int = 4,
+                  prefetch: int = 2,
+                  cache: Optional[LruCache[TaggerModel]] = None,
+                  fast_decode: bool = False
+                  ) -> Iterable[InferTagsResult]:
+    """
+    Preprocess images for the models into the tensor cache at `tensor_path`
+    without running the models, decoding each image once.
+    Images already cached are skipped. Results have no tags.
+    """
     log = logging.getLogger(__name__)
     for model in models:
-        repo_id = MODEL_REPO_MAP.get(model)
+        if model not in model_repo_map():
+            raise ValueError(f'Unknown model "{model}". Available models: {list(model_repo_map().keys())}')
 
-        log.info(f'Loading model "{model}" from "{repo_id}"...')
-        m: nn.Module = timm.create_model('hf-hub:' + repo_id).eval()
-        state_dict = timm.models.load_state_dict_from_hf(repo_id)
-        m.load_state_dict(state_dict)
+    transforms = [get_transform(m, cache) for m in models]
+    size = _decode_size(transforms, fast_decode)
+    staged = [(m, _preprocess(t, size)) for m, t in zip(models, transforms)]
+    for model, p in staged:
+        if p is None:
+            log.warning(f'Inputs of {model} have no fixed shape, not caching them')
+    preprocess = [p for _, p in staged if p is not None]
+    if len(preprocess) == 0:
+        return
+    files = [Path(f) for f in files]
+    digest = dict(zip(files, hash_files(files, workers)))
+    stores = _open_tensor_stores(tensor_path, preprocess)
+    try:
+        rows = [store.find([h for h in digest.values() if h is not None]) for store in stores]
+        targets: List[Path] = []
+        for f in files:
+            if digest[f] is not None and all(digest[f] in r for r in rows):
+                yield InferTagsResult(path=f, tags=None)
+            else:
+                targets.append(f)
+        load = lambda f: _load_staged(f, digest[f], preprocess, stores, rows, size)
+        for batch in _prefetch(targets, load, batch_size, workers, prefetch):
+            inputs: List[List[Tensor]] = []
+            loaded: List[Path] = []
+            for file, future in batch:
+                try:
+                    inputs.append(future.result())
+                    loaded.append(file)
+                except Exception as e:
+                    log.warning(f'Failed to load "{file}": {e}')
+                    yield InferTagsResult(path=file, tags=None, error=e)
+            if len(inputs) > 0:
+                _write_staged(loaded, inputs, digest, stores, rows)
+            for file in loaded:
+                yield InferTagsResult(path=file, tags=None)
+    finally:
+        for store in stores:
+            store.close()
 
-        log.info('Loading tag list...')
-        labels: LabelData = _load_labels(repo_id=repo_id)
+def infer_tags(files: List[str],
+               models: List[str]=["vit"], 
+               gen_threshold: float = 0.35,
+               char_threshold: float = 0.75,
+               batch_size: int = 1,
+               workers: int = 4,
+               prefetch: int = 2,
+               cache: Optional[LruCache[TaggerModel]] = None,
+               store_path: Optional[Path] = None,
+               rethreshold: bool = False,
+               ensemble: Optional[str] = None,
+               fast_decode: bool = False,
+               tensor_path: Optional[Path] = None,
+               backend: str = 'eager',
+               threads: Optional[int] = None,
+               export_path: Optional[Path] = None
+               ) -> Iterable[InferTagsResult]:
+    """
+    Tag images with the given models.
+
+    If `store_path` is given, the raw probabilities are stored there by image
+    content hash and model, and images already stored skip inference.
+    With `rethreshold`, captions are built only from stored probabilities.
+    With `ensemble` ('mean' or 'max'), every image is decoded once and the
+    probabilities of all models are combined into a single result.
+    With `fast_decode`, large images are decoded near the input size of the
+    models, much faster and lighter but with slightly different inputs.
+    If `tensor_path` is given, the preprocessed inputs are cached there by image
+    content hash and preprocessing, and cached images are not decoded again.
+    `backend` selects how the models run, see `get_backend`, and `threads` sets
+    the number of threads used within each operator.
+    """
+    import torch
 
-        log.info('Creating data transform...')
-        transform = create_transform(**resolve_data_config(m.pretrained_cfg, model=model))
-        files = [Path(f).resolve() for f in files]
+    # Check if the provided model is expected
+    for model in models:
+        if model not in model_repo_map():
+            raise ValueError(f'Unknown model "{model}". Available models: {list(model_repo_map().keys())}')
 
-        with torch.inference_mode():
-            # move model to GPU, if available
-            if torch_device.type != 'cpu':
-                m = m.to(torch_device)
+    if batch_size < 1:
+        raise ValueError(f'Batch size must be positive, got {batch_size}')
+    if workers < 1:
+        raise ValueError(f'Number of workers must be positive, got {workers}')
+    if prefetch < 0:
+        raise ValueError(f'Prefetch depth must not be negative, got {prefetch}')
+    if rethreshold and store_path is None:
+        raise ValueError('Rethresholding needs stored probabilities')
+    if ensemble is not None and ensemble not in ENSEMBLE_METHODS:
+        raise ValueError(f'Unknown ensemble method "{ensemble}". Available methods: {list(ENSEMBLE_METHODS.keys())}')
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend "{backend}". Available backends: {BACKENDS}')
+    if threads is not None and threads < 1:
+        raise ValueError(f'Number of threads must be positive, got {threads}')
 
-            import time
-            for file in files:
-                caption = _process_one(file, gen_threshold, char_threshold, m, labels, transform, torch_device)
-                yield InferTagsResult(path=file, tags=caption)
+    # Use GPU if available, quantized and ONNX models run on the CPU
+    on_cpu = backend in ('int8', 'onnx') or not torch.cuda.is_available()
+    torch_device = torch.device('cpu' if on_cpu else 'cuda')
 
-            if torch_device.type != 'cpu':
-                m = m.to('cpu')
+    files = [Path(f) for f in files]
+    hashes = hash_files(files, workers) if store_path is not None or tensor_path is not None else None
+    groups = [models] if ensemble is not None else [[m] for m in models]
+    combine = ENSEMBLE_METHODS[ensemble or 'mean']
+    # torch runs operators on one thread per physical core unless told otherwise
+    default_threads = torch.get_num_threads()
+    if threads is not None:
+        torch.set_num_threads(threads)
+    try:
+        for group in groups:
+            yield from _infer(files, hashes, group, combine,
+                              gen_threshold, char_threshold,
+                              batch_size, workers, prefetch,
+                              cache, store_path, rethreshold, fast_decode, tensor_path,
+                              backend, threads, export_path, torch_device)
+    finally:
+        torch.set_num_threads(default_threads)
@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+import re
+from typing import List, Tuple, Union
+
+# quoted tags, parentheses and words, where a backslash escapes the next character
+_TOKEN = re.compile(r'"(?P<quoted>[^"]*)"|(?P<paren>[()])|(?P<word>(?:\\.|[^\s()"\\])+)|(?P<error>\S)')
+_OPERATORS = {'AND', 'OR', 'NOT'}
+
+@dataclass
+class Term:
+    tag: str
+
+@dataclass
+class Not:
+    operand: 'Node'
+
+@dataclass
+class And:
+    operands: List['Node']
+
+@dataclass
+class Or:
+    operands: List['Node']
+
+Node = Union[Term, Not, And, Or]
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens: List[Tuple[str, str]] = []
+    words: List[str] = []
+    for m in _TOKEN.finditer(text):
+        if m.group('error') is not None:
+            raise ValueError(f'Unexpected {m.group()} at {m.start()} in query: {text}')
+        word = m.group('word')
+        if word is not None and word not in _OPERATORS:
+            # consecutive words form a single tag, like "red hair"
+            words.append(word)
+            continue
+        if words:
+            tokens.append(('tag', ' '.join(words)))
+            words = []
+        if m.group('quoted') is not None:
+            tokens.append(('tag', m.group('quoted')))
+        elif m.group('paren') is not None:
+            tokens.append((m.group('paren'), m.group('paren')))
+        else:
+            tokens.append((word, word))
+    if words:
+        tokens.append(('tag', ' '.join(words)))
+    return tokens
+
+class _Parser:
+    '''
+    Recursive descent parser, NOT binds tighter than AND which binds tighter than OR.
+    '''
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.index = 0
+    def peek(self) -> str:
+        return self.tokens[self.index][0] if self.index < len(self.tokens) else ''
+    def take(self, kind: str) -> str:
+        if self.peek() != kind:
+            found = self.tokens[self.index][1] if self.index < len(self.tokens) else 'end of query'
+            raise ValueError(f'Expected {kind} but found {found} in query: {self.text}')
+        self.index += 1
+        return self.tokens[self.index - 1][1]
+    def parse(self) -> Node:
+        node = self.disjunction()
+        if self.index < len(self.tokens):
+            raise ValueError(f'Unexpected {self.tokens[self.index][1]} in query: {self.text}')
+        return node
+    def disjunction(self) -> Node:
+        operands = [self.conjunction()]
+        while self.peek() == 'OR':
+            self.take('OR')
+            operands.append(self.conjunction())
+        return operands[0] if len(operands) == 1 else Or(operands)
+    def conjunction(self) -> Node:
+        operands = [self.negation()]
+        while self.peek() == 'AND':
+            self.take('AND')
+            operands.append(self.negation())
+        return operands[0] if len(operands) == 1 else And(operands)
+    def negation(self) -> Node:
+        if self.peek() == 'NOT':
+            self.take('NOT')
+            return Not(self.negation())
+        if self.peek() == '(':
+            self.take('(')
+            node = self.disjunction()
+            self.take(')')
+            return node
+        return Term(self.take('tag'))
+
+def parse_query(text: str) -> Node:
+    '''
+    Parse a boolean tag query such as `1girl AND (red hair OR blue hair) AND NOT solo`.
+    Tags containing parentheses or operators can be quoted.
+    '''
+    return _Parser(text).parse()
+
+def _compile(node: Node, params: List[str]) -> str:
+    if isinstance(node, Term):
+        params.append(node.tag)
+        return "SELECT image_id FROM image_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?)"
+    if isinstance(node, Not):
+        return f"SELECT id as image_id FROM images EXCEPT SELECT image_id FROM ({_compile(node.operand, params)})"
+    if isinstance(node, Or):
+        return " UNION ".join(f"SELECT image_id FROM ({_compile(o, params)})" for o in node.operands)
+    # negated operands are subtracted from the others, which avoids the complement of the whole dataset
+    positive = [o for o in node.operands if not isinstance(o, Not)]
+    negative = [o.operand for o in node.operands if isinstance(o, Not)]
+    if positive:
+        query = " INTERSECT ".join(f"SELECT image_id FROM ({_compile(o, params)})" for o in positive)
+    else:
+        query = "SELECT id as image_id FROM images"
+    for o in negative:
+        query = f"SELECT image_id FROM ({query}) EXCEPT SELECT image_id FROM ({_compile(o, params)})"
+    return query
+
+def compile_query(text: str) -> Tuple[str, List[str]]:
+    '''
+    Compile a boolean tag query to SQL returning the matching image ids, and its parameters.
+    Every tag is looked up through the index on image_tags, and the operators
+    become set operations evaluated by SQLite.
+    '''
+    params: List[str] = []
+    return _compile(parse_query(text), params), params
@@ -1,18 +1,67 @@
+from bisect import bisect_left
 from dataclasses import dataclass
-from typing import Callable, Iterable, List, Optional
+from functools import lru_cache
+from typing import Callable, Iterable, List, Optional, Tuple
+import os
 import re
 
-from controllers.captions import Captions
 from models.context import Context
+from .bulk import Mutation, MutationResult
 from .transaction import Txn
 
-import Levenshtein as levenshtein
-
 @dataclass
 class TagsListItem:
     tag: str
     count: int
 
+def _character_pattern(path: str) -> re.Pattern:
+    '''
+    Combine the patterns of the file, one per line, into a single compiled regex.
+    The regex is compiled again when the file is modified.
+    '''
+    return _compile_patterns(path, os.stat(path).st_mtime_ns)
+
+@lru_cache(maxsize=1)
+def _compile_patterns(path: str, mtime: int) -> re.Pattern:
+    with open(path, 'r') as file:
+        keywords = [line.strip() for line in file.readlines() if len(line.strip()) > 0]
+    return re.compile('|'.join(f'(?:{k})' for k in keywords))
+
+def _containers(vocabulary: List[Tuple[int, str]], min_length: int) -> List[Tuple[int, int]]:
+    '''
+    Return the pairs (tag id, id of another tag containing it) for tags longer than min_length.
+    Every suffix of the vocabulary is sorted, so the tags containing a tag are those
+    owning the range of suffixes starting with it.
+    '''
+    suffixes = sorted((name[k:], i) for i, name in vocabulary for k in range(len(name)))
+    keys = [s for s, _ in suffixes]
+    pairs = []
+    for i, name in vocabulary:
+        if len(name) <= min_length:
+            continue
+        lo = bisect_left(keys, name)
+        hi = bisect_left(keys, name + '\U0010ffff', lo)
+        pairs.extend((i, o) for o in {o for _, o in suffixes[lo:hi]} if o != i)
+    return pairs
+
+@dataclass
+class CooccurrenceItem:
+    tag: str
+    count: int
+    # share of the files with the queried tag which also have this tag
+    confidence: float
+    # share of the files with this tag which also have the queried tag
+    reverse: float
+
+@dataclass
+class ImplicationItem:
+    antecedent: str
+    consequent: str
+    support: int
+    confidence: float
+    # files with the antecedent but not the consequent
+    missing: int
+
 class Tags:
     context: Context
     def __init__(self, context):
@@ -20,150 +69,139 @@ class Tags:
     def list(self, filter:str = None, skip:int = 0, head:int = -1, threshold:int = 1) -> Iterable[TagsListItem]:
         with Txn.begin(self.context.conn) as cur:
             query = \
-                "SELECT JSON_EACH.VALUE, COUNT(*) as count " \
-                "FROM images as i, JSON_EACH(i.tags), selected as s " \
-                "WHERE i.path = s.path " \
-                "GROUP BY JSON_EACH.VALUE "
-            query += f"HAVING count >= {threshold} "
+                "SELECT t.name, c.count " \
+                "FROM tag_counts as c, tags as t " \
+                "WHERE c.tag_id = t.id AND c.count >= ? "
+            params = [threshold]
             if filter:
-                query += f"AND JSON_EACH.VALUE LIKE '%{filter}%' "
-            query += f"ORDER BY count DESC LIMIT {head} OFFSET {skip} "
-            cur.execute(query)
-            for tag, count in cur:
-                yield TagsListItem(tag, count)
+                tags, tags_params = self.context.dataset._tag_filter(filter)
+                query += f"AND c.tag_id IN ({tags}) "
+                params += tags_params
+            query += "ORDER BY c.count DESC, t.name LIMIT ? OFFSET ? "
+            params += [head, skip]
+            cur.execute(query, params)
+            rows = cur.fetchall()
+        for tag, count in rows:
+            yield TagsListItem(tag, count)
     def verify(self, items: Iterable[TagsListItem]) -> Iterable[TagsListItem]:
-        for i in items:
-            text = self.context.lookup(i.tag)
+        items = list(items)
+        for i, text in zip(items, self.context.lookup_many(i.tag for i in items)):
             if text is None:
                 yield i
     def add(self,
             tags: List[str], 
-            tail: bool=False):
-        c = Captions(self.context)
-        target = c.list(selected=True)
-        count = 0
-        with Txn.begin(self.context.conn) as cur:
-            for i in target:
-                existing = i.tags
-                adding: List[str] = []
-                for tag in tags:
-                    if tag not in existing:
-                        adding.append(tag)
-                if len(adding) == 0:
-                    continue
-                if tail:
-                    existing += tags
-                else:
-                    existing = tags + existing
-                c.update(i.path, tags=existing)
-                count += 1
-        return count
-    def remove(self, 
-               tags: List[str], 
-               progress_wrapper: Optional[Callable] = None, 
-               progress_post: Optional[Callable] = None):
-        c = Captions(self.context)
-        target = c.list(selected=True)
-        if progress_wrapper:
-            target = progress_wrapper(target)
-        count = 0
-        with Txn.begin(self.context.conn) as cur:
-            for i in target:
-                existing = i.tags
-                removing: List[str] = []
-                for t in tags:
-                    if t in existing:
-                        removing.append(t)
-                if len(removing) == 0:
-                    continue
-                for t in removing:
-                    existing.remove(t)
-                c.update(i.path, tags=existing)
-                count += 1
-        if progress_post:
-            progress_post()
-        return count
-    def replace(self, old: str, new: str):
-        c = Captions(self.context)
-        target = c.list(selected=True, filter=old)
-        count = 0
-        with Txn.begin(self.context.conn) as cur:
-            for i in target:
-                res = []
-                for t in i.tags:
-                    t = t.replace(old, new).strip(' ')
-                    if len(t) != 0 and t not in res:
-                        res.append(t)
-                c.update(i.path, tags=res)
-                count += 1
-        return count
-
-    def prune(self, /, min_length:int=3, *, inclusion=False, character=False, keep:List[str]=None) -> tuple[int, List[str]]:
-        c = Captions(self.context)
-        target = c.list(selected=True)
-        count = 0
-        pruned = []
-        if inclusion:
-            with Txn.begin(self.context.conn) as cur:
-                for i in target:
-                    res = []
-                    for t in i.tags:
-                        if len(t) <= min_length:
-                            res.append(t)
-                            continue
-                        is_contained = False
-                        for r in i.tags:
-                            if t == r:
-                                continue
-                            if t in r:
-                                is_contained = True
-                                break
-                        if not is_contained:
-                            res.append(t)
-                        elif t not in pruned:
-                            pruned.append(t)
-                    c.update(i.path, tags=res)
-                    count += 1
-        if character:
-            with open('assets/character_tags.txt', 'r') as file:
-                keywords = [line.strip() for line in file.readlines() if not len(line) == 0 or not line.isspace()]
-            with Txn.begin(self.context.conn) as cur:
-                for i in target:
-                    res = []
-                    for t in i.tags:
-                        if keep is not None and t in keep:
-                            res.append(t)
-                        elif not any(re.match(keyword, t) for keyword in keywords):
-                            res.append(t)
-                        elif t not in pruned:
-                            pruned.append(t)
-                    c.update(i.path, tags=res)
-                    count += 1
-        return count, pruned
+            tail: bool=False) -> MutationResult:
+        tags = list(dict.fromkeys(tags))
+        with Mutation.begin(self.context) as m:
+            ids = m.tag_ids(tags)
+            m.target(ids.values())
+            # files missing any of the tags
+            m.touch("SELECT s.image_id FROM selected as s WHERE " \
+                    "(SELECT COUNT(DISTINCT it.tag_id) FROM image_tags as it, target_tags as t " \
+                    "WHERE it.image_id = s.image_id AND it.tag_id = t.tag_id) < ?", (len(ids), ))
+            # one tag at a time, next to the first or the last position of each file
+            position = "COALESCE((SELECT MAX(position) FROM image_tags WHERE image_id = a.image_id) + 1, 0)" if tail else \
+                       "COALESCE((SELECT MIN(position) FROM image_tags WHERE image_id = a.image_id) - 1, 0)"
+            for tag in (tags if tail else reversed(tags)):
+                m.execute("INSERT INTO image_tags (image_id, tag_id, position) " \
+                          f"SELECT a.image_id, ?, {position} FROM affected as a " \
+                          "WHERE NOT EXISTS (SELECT 1 FROM image_tags WHERE image_id = a.image_id AND tag_id = ?)",
+                          (ids[tag], ids[tag]))
+        return m.result
+    def remove(self, tags: List[str]) -> MutationResult:
+        with Mutation.begin(self.context) as m:
+            m.target(m.find_tag_ids(tags).values())
+            m.touch("SELECT DISTINCT it.image_id FROM image_tags as it, selected as s, target_tags as t " \
+                    "WHERE it.image_id = s.image_id AND it.tag_id = t.tag_id")
+            m.execute("DELETE FROM image_tags WHERE tag_id IN (SELECT tag_id FROM target_tags) " \
+                      "AND image_id IN (SELECT image_id FROM affected)")
+        return m.result
+    def replace(self, old: str, new: str) -> MutationResult:
+        with Mutation.begin(self.context) as m:
+            # decide the replacement once per tag in the vocabulary
+            m.cur.execute("SELECT id, name FROM tags")
+            vocabulary = m.cur.fetchall()
+            m.target(i for i, name in vocabulary if old in name)
+            m.touch("SELECT DISTINCT it.image_id FROM image_tags as it, selected as s, target_tags as t " \
+                    "WHERE it.image_id = s.image_id AND it.tag_id = t.tag_id")
+            # every tag of the files is replaced and stripped, and empty tags are dropped
+            mapping = {i: name.replace(old, new).strip(' ') for i, name in vocabulary}
+            mapping = {i: n for (i, name), n in zip(vocabulary, mapping.values()) if n != name or len(n) == 0}
+            ids = m.tag_ids(n for n in mapping.values() if len(n) > 0)
+            m.cur.execute("CREATE TEMP TABLE IF NOT EXISTS tag_map (old_id INTEGER PRIMARY KEY, new_id INTEGER)")
+            m.cur.execute("DELETE FROM tag_map")
+            m.cur.executemany("INSERT INTO tag_map (old_id, new_id) VALUES (?, ?)",
+                              [(i, ids.get(n)) for i, n in mapping.items()])
+            m.execute("DELETE FROM image_tags WHERE image_id IN (SELECT image_id FROM affected) " \
+                      "AND tag_id IN (SELECT old_id FROM tag_map WHERE new_id IS NULL)")
+            m.execute("UPDATE image_tags SET tag_id = (SELECT new_id FROM tag_map WHERE old_id = image_tags.tag_id) " \
+                      "WHERE image_id IN (SELECT image_id FROM affected) AND tag_id IN (SELECT old_id FROM tag_map)")
+            # keep the first of duplicated tags
+            m.execute("DELETE FROM image_tags WHERE image_id IN (SELECT image_id FROM affected) " \
+                      "AND EXISTS (SELECT 1 FROM image_tags as b WHERE b.image_id = image_tags.image_id " \
+                      "AND b.tag_id = image_tags.tag_id AND b.position < image_tags.position)")
+        return m.result
+
+    def prune(self, /, min_length:int=3, *, inclusion=False, character=False, keep:List[str]=None) -> tuple[MutationResult, List[str]]:
+        keep = set(keep or [])
+        with Mutation.begin(self.context) as m:
+            # decide once per tag of the selection, then delete the occurrences in one pass
+            m.cur.execute("SELECT t.id, t.name FROM tag_counts as c, tags as t WHERE c.tag_id = t.id")
+            vocabulary = m.cur.fetchall()
+            kept = {i for i, name in vocabulary if name in keep}
+            m.cur.execute("CREATE TEMP TABLE IF NOT EXISTS prune_rows (image_id INTEGER, tag_id INTEGER, PRIMARY KEY (image_id, tag_id))")
+            m.cur.execute("DELETE FROM prune_rows")
+            if inclusion:
+                # a tag is pruned from a file which also has a longer tag containing it
+                m.cur.execute("CREATE TEMP TABLE IF NOT EXISTS containers (tag_id INTEGER, container_id INTEGER, PRIMARY KEY (tag_id, container_id))")
+                m.cur.execute("DELETE FROM containers")
+                m.cur.executemany("INSERT INTO containers (tag_id, container_id) VALUES (?, ?)",
+                                  [(i, o) for i, o in _containers(vocabulary, min_length) if i not in kept])
+                # CROSS JOIN keeps the join order, starting from the few pairs rather than every tag occurrence
+                m.cur.execute("INSERT OR IGNORE INTO prune_rows (image_id, tag_id) " \
+                              "SELECT DISTINCT it.image_id, it.tag_id FROM containers as c " \
+                              "CROSS JOIN image_tags as it CROSS JOIN image_tags as o CROSS JOIN selected as s " \
+                              "WHERE it.tag_id = c.tag_id AND it.image_id = s.image_id " \
+                              "AND o.image_id = it.image_id AND o.tag_id = c.container_id")
+            if character:
+                pattern = _character_pattern('assets/character_tags.txt')
+                m.target(i for i, name in vocabulary if i not in kept and pattern.match(name))
+                m.cur.execute("INSERT OR IGNORE INTO prune_rows (image_id, tag_id) " \
+                              "SELECT DISTINCT it.image_id, it.tag_id FROM target_tags as t, image_tags as it, selected as s " \
+                              "WHERE it.tag_id = t.tag_id AND it.image_id = s.image_id")
+            m.touch("SELECT DISTINCT image_id FROM prune_rows")
+            m.execute("DELETE FROM image_tags WHERE image_id IN (SELECT image_id FROM affected) " \
+                      "AND EXISTS (SELECT 1 FROM prune_rows as p WHERE p.image_id = image_tags.image_id AND p.tag_id = image_tags.tag_id)")
+            m.cur.execute("SELECT DISTINCT t.name FROM prune_rows as p, tags as t WHERE p.tag_id = t.id")
+            pruned = [name for name, in m.cur.fetchall()]
+        return m.result, pruned
     
-    def distance(self, threshold:int) -> Iterable[tuple[str, str, int]]:
+    def distance(self, threshold:int, workers:Optional[int] = None) -> Iterable[tuple[str, str, int]]:
         """
         タグ間のレーベンシュタイン距離を計算し、指定された閾値以下のものを返却します。
 
         引数:
             threshold (int): 返却する最大距離
+            workers (int): 候補の検証に使うプロセス数。省略時は CPU 数
 
         yield:
             Iterable[Tuple[str, str, int]]: タグとその距離を含むタプル。
 
         注意:
-            この関数は、リスト内の各タグを他のすべてのタグと比較し、レーベンシュタイン距離を計算します。
-            距離が閾値以下の場合、タグとその距離が生成されます。
+            長さと共有する q-gram の数で候補を絞り込んでから、レーベンシュタイン距離を計算します。
+            結果はすべてのタグの組を比較した場合と同じで、リスト内の順に生成されます。
         """
-        tags = list(self.list())
-        while len(tags) > 0:
-            t = tags.pop(0)
-            for a in tags:
-                d = levenshtein.distance(t.tag, a.tag)
-                if d <= threshold:
-                    yield (t.tag, a.tag, d)
-
-    def order(self, tag: str, index: int) -> int:
+        tags = [t.tag for t in self.list()]
+        # the index does not depend on the threshold, keep it until the tags change
+        index = self.context.distance_index
+        if index is None or index.strings != tags:
+            from .distance import QGramIndex
+            index = QGramIndex(tags)
+            self.context.distance_index = index
+        for i, j, d in index.pairs(threshold, workers):
+            yield (tags[i], tags[j], d)
+
+    def order(self, tag: str, index: int) -> MutationResult:
         """
         指定されたタグの順序を変更します。
 
@@ -172,14 +210,97 @@ class Tags:
             index (int): 移動先のインデックス
 
         return:
-            int: 更新されたタグを含むキャプションの数
+            MutationResult: 更新されたキャプションの数、変更された行数と処理時間
+        """
+        with Mutation.begin(self.context) as m:
+            ids = m.find_tag_ids([tag])
+            if len(ids) > 0:
+                # number the other tags from 0 and leave a gap at the destination, like list.insert
+                m.cur.execute("CREATE TEMP TABLE IF NOT EXISTS destination (image_id INTEGER PRIMARY KEY, position INTEGER, target INTEGER)")
+                m.cur.execute("DELETE FROM destination")
+                m.cur.execute("INSERT INTO destination (image_id, position, target) " \
+                              "SELECT it.image_id, MIN(it.position) FILTER (WHERE it.tag_id = ?), " \
+                              "CASE WHEN ? >= 0 THEN MIN(?, COUNT(*) - 1) ELSE MAX(0, COUNT(*) - 1 + ?) END " \
+                              "FROM image_tags as it WHERE it.image_id IN (SELECT h.image_id FROM image_tags as h, selected as s " \
+                              "WHERE h.image_id = s.image_id AND h.tag_id = ?) GROUP BY it.image_id",
+                              (ids[tag], index, index, index, ids[tag]))
+                # files where the tag is already at the destination are left alone
+                m.cur.execute("DELETE FROM destination WHERE target = " \
+                              "(SELECT COUNT(*) FROM image_tags as it WHERE it.image_id = destination.image_id AND it.position < destination.position)")
+                m.touch("SELECT image_id FROM destination")
+                m.cur.execute("CREATE TEMP TABLE IF NOT EXISTS reorder (image_id INTEGER, tag_id INTEGER, old INTEGER, position INTEGER)")
+                m.cur.execute("DELETE FROM reorder")
+                m.cur.execute("INSERT INTO reorder (image_id, tag_id, old, position) " \
+                              "SELECT image_id, tag_id, position, rank + (rank >= target) FROM (" \
+                              "SELECT it.image_id, it.tag_id, it.position, d.target, " \
+                              "ROW_NUMBER() OVER (PARTITION BY it.image_id ORDER BY it.position) - 1 as rank " \
+                              "FROM destination as d, image_tags as it " \
+                              "WHERE it.image_id = d.image_id AND it.position != d.position)")
+                m.cur.execute("INSERT INTO reorder (image_id, tag_id, old, position) SELECT image_id, ?, position, target FROM destination", (ids[tag], ))
+                # move only the rows whose position changes, the others keep theirs which no moved row takes
+                m.cur.execute("DELETE FROM reorder WHERE old = position")
+                m.execute("DELETE FROM image_tags WHERE (image_id, position) IN (SELECT image_id, old FROM reorder)")
+                m.cur.execute("INSERT INTO image_tags (image_id, tag_id, position) SELECT image_id, tag_id, position FROM reorder")
+        return m.result
+
+    def cooccur(self, tag: str, head: int = 20) -> List[CooccurrenceItem]:
+        """
+        選択されたファイルで、指定されたタグと同時に現れるタグを集計します。
+
+        引数:
+            tag (str): 対象のタグ
+            head (int): 返却する最大件数。負の値はすべて
+
+        return:
+            List[CooccurrenceItem]: 同時に現れるファイル数の多い順のタグ
+        """
+        import numpy as np
+        from models.matrix import selected_rows, tag_names
+        with Txn.begin(self.context.conn) as cur:
+            cur.execute("SELECT id FROM tags WHERE name = ?", (tag, ))
+            row = cur.fetchone()
+            rows = selected_rows(cur, self.context.dataset._tag_matrix(cur))
+            if row is None or row[0] >= rows.shape[1]:
+                return []
+            counts = np.asarray(rows.sum(axis=0)).ravel()
+            # column sums over the files having the tag
+            having = rows[rows[:, row[0]].nonzero()[0]]
+            together = np.asarray(having.sum(axis=0)).ravel()
+            together[row[0]] = 0
+            ids = np.flatnonzero(together)
+            ids = ids[np.lexsort((ids, -together[ids]))]
+            if head >= 0:
+                ids = ids[:head]
+            names = tag_names(cur, ids)
+        return [CooccurrenceItem(name, int(together[i]), float(together[i] / counts[row[0]]), float(together[i] / counts[i]))
+                for name, i in zip(names, ids)]
+
+    def implied(self, threshold: float = 0.98, min_count: int = 5) -> List[ImplicationItem]:
+        """
+        選択されたファイルで、あるタグを持つファイルのほとんどが別のタグも持つ組を探します。
+
+        引数:
+            threshold (float): 前件のタグを持つファイルのうち、後件のタグも持つ割合の下限
+            min_count (int): 前件のタグを持つファイル数の下限
+
+        return:
+            List[ImplicationItem]: 割合の高い順の組。後件が欠けているファイルには追加を検討できます
         """
-        c = Captions(self.context)
-        target = c.list(selected=True, filter=tag)
-        count = 0
-        for t in target:
-            t.tags.pop(t.tags.index(tag))
-            t.tags.insert(index, tag)
-            c.update(t.path, tags=t.tags)
-            count+=1
-        return count
+        import numpy as np
+        from models.matrix import selected_rows, tag_names
+        with Txn.begin(self.context.conn) as cur:
+            rows = selected_rows(cur, self.context.dataset._tag_matrix(cur)).tocsc()
+            counts = np.asarray(rows.sum(axis=0)).ravel()
+            antecedents = np.flatnonzero(counts >= min_count)
+            # co-occurrence of every frequent tag with every tag, as one sparse product
+            pairs = (rows[:, antecedents].T @ rows).tocoo()
+            a = antecedents[pairs.row]
+            confidence = pairs.data / counts[a]
+            keep = (confidence >= threshold) & (a != pairs.col)
+            a, c, together, confidence = a[keep], pairs.col[keep], pairs.data[keep], confidence[keep]
+            order = np.lexsort((c, a, -counts[a], -confidence))
+            a, c, together, confidence = a[order], c[order], together[order], confidence[order]
+            ids = np.unique(np.concatenate([a, c]))
+            name = dict(zip(ids.tolist(), tag_names(cur, ids)))
+        return [ImplicationItem(name[x], name[y], int(counts[x]), float(f), int(counts[x] - t))
+                for x, y, t, f in zip(a.tolist(), c.tolist(), together.tolist(), confidence.tolist())]
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+from typing import Generic, List, Optional, TypeVar
+
+T = TypeVar('T')
+
+@dataclass
+class CacheEntry(Generic[T]):
+    key: str
+    value: T
+    size: int
+
+class LruCache(Generic[T]):
+    '''
+    Keep values in least-recently-used order within a memory budget in bytes.
+    The most recent entry is kept even if it exceeds the budget alone.
+    '''
+    budget: int
+    entries: 'OrderedDict[str, CacheEntry[T]]'
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.entries = OrderedDict()
+    @property
+    def used(self) -> int:
+        return sum(e.size for e in self.entries.values())
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+    def __len__(self) -> int:
+        return len(self.entries)
+    def get(self, key: str) -> Optional[T]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry.value
+    def put(self, key: str, value: T, size: int) -> List[str]:
+        self.entries[key] = CacheEntry(key, value, size)
+        self.entries.move_to_end(key)
+        return self._evict()
+    def pop(self, key: str) -> Optional[T]:
+        entry = self.entries.pop(key, None)
+        return None if entry is None else entry.value
+    def clear(self) -> List[str]:
+        keys = list(self.entries.keys())
+        self.entries.clear()
+        return keys
+    def list(self) -> List[CacheEntry[T]]:
+        '''
+        Return entries from the least to the most recently used.
+        '''
+        return list(self.entries.values())
+    def _evict(self) -> List[str]:
+        log = logging.getLogger(__name__)
+        evicted: List[str] = []
+        while len(self.entries) > 1 and self.used > self.budget:
+            key, _ = self.entries.popitem(last=False)
+            log.info(f'Evicted "{key}" from cache')
+            evicted.append(key)
+        return evicted
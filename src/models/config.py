@@ -0,0 +1,16 @@
+from functools import lru_cache
+from typing import Any, Dict
+import tomllib as toml
+
+CONFIG_PATH = 'assets/config.tom'
+
+@lru_cache
+def load_config() -> Dict[str, Any]:
+    '''
+    Read the configuration file on first use.
+    '''
+    with open(CONFIG_PATH, 'rb') as f:
+        return toml.load(f)
+
+def model_repo_map() -> Dict[str, str]:
+    return load_config()['MODELS']
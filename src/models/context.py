@@ -1,18 +1,39 @@
 from .dictionary import Dictionary
+from .cache import LruCache
+import os
 from pathlib import Path
 import sqlite3
-from models.dataset import Dataset
+from typing import Iterable, List, Optional
+from models.dataset import Dataset, LoadResult
+from models.watcher import Watcher
 class Context():
     root_path: Path
     exiting: bool = False
     conn: sqlite3.Connection = sqlite3.connect(":memory:", autocommit=False)
-    dictionary: Dictionary = Dictionary.load("assets/tags_ja-JP.csv")
+    dictionary: Dictionary = Dictionary("assets/tags_ja-JP.csv")
+    models: LruCache = LruCache(budget=int(os.environ.get('TAGGER_MODEL_CACHE_MB', '4096')) * 1024 * 1024)
     dataset :Dataset = None
-    def __init__(self, path: Path):
+    distance_index = None
+    watcher: Optional[Watcher] = None
+    def __init__(self, path: Path, index: bool = False, watch: bool = False):
         self.root_path = path
-        self.dataset = Dataset(self.conn).load(path)
-    def lookup(self, key: str) -> str:
-        v = self.dictionary[key]
-        if v is None:
-            v = self.dictionary[key.replace(' ', '_')]
-        return v
+        # started first, the watches are in place when start returns, so that nothing changed during the load is missed
+        self.watcher = Watcher(str(Path(path))).start() if watch else None
+        self.dataset = Dataset(self.conn, index_path=self.cache_path/'index.db' if index else None).load(path)
+    def sync(self) -> Optional[LoadResult]:
+        '''
+        Apply the changes on disk reported by the watcher since the last call.
+        '''
+        if self.watcher is None:
+            return None
+        changes = self.watcher.drain()
+        if not changes:
+            return None
+        return self.dataset.update(changes.paths, changes.directories)
+    @property
+    def cache_path(self) -> Path:
+        return Path(self.root_path)/'.tagger'
+    def lookup(self, key: str) -> Optional[str]:
+        return self.dictionary[key]
+    def lookup_many(self, keys: Iterable[str]) -> List[Optional[str]]:
+        return self.dictionary.lookup_many(keys)
@@ -1,48 +1,432 @@
 import json
+import logging
 import os
 import re
 import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import groupby
 from pathlib import Path
-from typing import Set
+from typing import Dict, Iterable, List, Optional, Set
 from controllers.transaction import Txn
+from .journal import Journal
 
 SUPPORTED_FORMATS = set(['.jpg', '.jpeg', '.png', '.webp'])
+SCAN_WORKERS = 16
+
+@dataclass
+class LoadResult:
+    added: int = 0
+    changed: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+    elapsed: float = 0.0
+    conflicts: List[str] = field(default_factory=list)
+    # files with unsaved tags which were deleted on disk, losing the tags
+    lost: List[str] = field(default_factory=list)
+    @property
+    def files(self) -> int:
+        return self.added + self.changed + self.unchanged
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.elapsed if self.elapsed > 0 else 0.0
+
+def _stat(path: Path) -> Optional[os.stat_result]:
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+def _scan_directory(path: str) -> tuple[List[tuple[str, int, int, Optional[int]]], List[str]]:
+    # pair images with captions from the directory listing instead of probing each caption
+    rows = []
+    directories = []
+    try:
+        with os.scandir(path) as it:
+            entries = {e.name: e for e in it}
+    except OSError as e:
+        # like os.walk, skip what cannot be listed
+        logging.getLogger(__name__).warning(f'Failed to scan "{path}": {e}')
+        return rows, directories
+    for e in entries.values():
+        try:
+            if e.is_dir(follow_symlinks=False):
+                directories.append(e.path)
+                continue
+            stem, suffix = os.path.splitext(e.name)
+            if not suffix.lower() in SUPPORTED_FORMATS:
+                # Ignore unsupported formats
+                continue
+            # a broken link or a file deleted during the scan only skips that entry
+            image = e.stat()
+        except OSError:
+            continue
+        caption = entries.get(stem + '.txt')
+        try:
+            caption_mtime = None if caption is None else caption.stat().st_mtime_ns
+        except OSError:
+            caption_mtime = None
+        rows.append((e.path, image.st_mtime_ns, image.st_size, caption_mtime))
+    return rows, directories
+
+def _scan(pool: ThreadPoolExecutor, path: str) -> Iterable[List[tuple[str, int, int, Optional[int]]]]:
+    # list directories in parallel, yielding the images of each directory
+    pending = {pool.submit(_scan_directory, path)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            rows, directories = f.result()
+            pending |= {pool.submit(_scan_directory, d) for d in directories}
+            if rows:
+                yield rows
+
+def _stat_image(path: str) -> Optional[tuple[str, int, int, Optional[int]]]:
+    # the same row as a directory scan, for a single image
+    image = _stat(path)
+    if image is None or not os.path.isfile(path):
+        return None
+    caption = _stat(os.path.splitext(path)[0] + '.txt')
+    return (path, image.st_mtime_ns, image.st_size, None if caption is None else caption.st_mtime_ns)
+
+def _read_tags(caption_filepath: Path) -> List[str]:
+    with open(caption_filepath, 'rt') as f:
+        return [s.strip() for s in re.split(r',|\n|\r', f.read())]
+
+@lru_cache(maxsize=64)
+def _compile_regexp(pattern: str) -> re.Pattern:
+    return re.compile(pattern)
+
+def _regexp(pattern: str, value: Optional[str]) -> bool:
+    # `value REGEXP pattern` in SQL, matching from the start like re.match
+    return value is not None and _compile_regexp(pattern).match(value) is not None
 
 class Dataset:
     conn :sqlite3.Connection = None
-    def __init__(self, connection):
+    index_path :Optional[Path] = None
+    last_load :LoadResult = None
+    journal :Journal = None
+    _matrix = None
+    def __init__(self, connection, index_path: Optional[Path] = None):
         self.conn = connection
+        self.index_path = index_path
+        self.journal = Journal(self)
+        self.conn.create_function("REGEXP", 2, _regexp, deterministic=True)
     '''
     Select all files in the dataset.
     Create a table named 'selected' if not there and set default values.
     '''
     def _select_all_files(self):
         with Txn.begin(self.conn) as cur:
-            cur.execute("CREATE TABLE IF NOT EXISTS selected (path TEXT PRIMARY KEY)")
+            cur.execute("CREATE TABLE IF NOT EXISTS selected (image_id INTEGER PRIMARY KEY)")
             cur.execute("DELETE FROM selected")
-            cur.execute("INSERT INTO selected (path) SELECT path FROM images")
-            return cur.rowcount
+            cur.execute("INSERT INTO selected (image_id) SELECT id FROM images")
+            count = cur.rowcount
+            self._count_selected(cur)
+            return count
+    '''
+    Count the tags of the selected files from scratch.
+    Call this after changing the selection, the triggers on image_tags keep it up to date afterwards.
+    '''
+    def _count_selected(self, cur: sqlite3.Cursor):
+        cur.execute("DELETE FROM tag_counts")
+        # a small selection is joined from its own rows, a large one by scanning image_tags in tag order
+        cur.execute("SELECT (SELECT COUNT(*) FROM selected) * 3 < (SELECT COUNT(*) FROM images)")
+        tables = "selected as s CROSS JOIN image_tags as it" if cur.fetchone()[0] else "image_tags as it, selected as s"
+        cur.execute("INSERT INTO tag_counts (tag_id, count) " \
+                    f"SELECT it.tag_id, COUNT(*) FROM {tables} " \
+                    "WHERE it.image_id = s.image_id GROUP BY it.tag_id")
+    '''
+    Return a query of the ids of the tags containing the filter, case insensitive, and its parameters.
+    A filter starting with ^ matches the beginning of the tags only.
+    Filters of three characters or more are looked up in the trigram index.
+    '''
+    def _tag_filter(self, filter: str) -> tuple[str, tuple]:
+        prefix = filter.startswith('^')
+        text = filter[1:] if prefix else filter
+        if len(text) < 3:
+            # too short for trigrams, scan the vocabulary which is small compared to the occurrences
+            return f"SELECT id FROM tags WHERE instr(lower(name), lower(?)) {'= 1' if prefix else '> 0'}", (text, )
+        phrase = '"' + text.replace('"', '""') + '"'
+        if prefix:
+            return "SELECT rowid FROM tags_fts WHERE tags_fts MATCH ? AND lower(substr(name, 1, ?)) = lower(?)", \
+                   (phrase, len(text), text)
+        return "SELECT rowid FROM tags_fts WHERE tags_fts MATCH ?", (phrase, )
+    '''
+    Return the image by tag matrix, brought up to date with the edits since the last call.
+    '''
+    def _tag_matrix(self, cur: sqlite3.Cursor):
+        # numpy and scipy are loaded on first use only
+        from .matrix import TagMatrix
+        if self._matrix is None:
+            self._matrix = TagMatrix()
+        return self._matrix.refresh(cur)
+    '''
+    Return the ids of the given tag names, adding unknown names to the vocabulary.
+    '''
+    def _tag_ids(self, cur: sqlite3.Cursor, names: Iterable[str]) -> Dict[str, int]:
+        names = list(dict.fromkeys(names))
+        cur.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(n, ) for n in names])
+        ids: Dict[str, int] = {}
+        for n in names:
+            cur.execute("SELECT id FROM tags WHERE name = ?", (n, ))
+            ids[n] = cur.fetchone()[0]
+        return ids
+    '''
+    Replace the tags of an image keeping their order.
+    '''
+    def _set_tags(self, cur: sqlite3.Cursor, image_id: int, tags: List[str]):
+        ids = self._tag_ids(cur, tags)
+        cur.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id, ))
+        cur.executemany("INSERT INTO image_tags (image_id, tag_id, position) VALUES (?, ?, ?)",
+                        [(image_id, ids[t], i) for i, t in enumerate(tags)])
+    '''
+    Mark the images returned by the query of image ids as modified when their tags
+    differ from the caption on disk, and as saved when an edit brought them back to it.
+    Return the number of images checked.
+    '''
+    def _mark_dirty(self, cur: sqlite3.Cursor, query: str, params: tuple = ()) -> int:
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS dirty_check (image_id INTEGER PRIMARY KEY)")
+        cur.execute("DELETE FROM dirty_check")
+        cur.execute("INSERT OR IGNORE INTO dirty_check (image_id) " + query, params)
+        cur.execute("SELECT q.image_id, t.name FROM dirty_check as q " \
+                    "CROSS JOIN image_tags as it CROSS JOIN tags as t WHERE it.image_id = q.image_id AND t.id = it.tag_id " \
+                    "ORDER BY it.image_id, it.position")
+        tags: Dict[int, List[str]] = {}
+        for image_id, name in cur.fetchall():
+            tags.setdefault(image_id, []).append(name)
+        cur.execute("SELECT i.id, f.tags FROM dirty_check as q " \
+                    "JOIN images as i ON i.id = q.image_id JOIN idx.files as f ON f.path = i.path")
+        dirty = [(int(json.loads(saved) != tags.get(image_id, [])), image_id) for image_id, saved in cur.fetchall()]
+        cur.executemany("UPDATE images SET dirty = ? WHERE id = ?", dirty)
+        return len(dirty)
+    '''
+    Return the tags of an image in order.
+    '''
+    def _get_tags(self, cur: sqlite3.Cursor, image_id: int) -> List[str]:
+        cur.execute("SELECT t.name FROM image_tags as it, tags as t " \
+                    "WHERE it.image_id = ? AND it.tag_id = t.id ORDER BY it.position", (image_id, ))
+        return [row[0] for row in cur.fetchall()]
+    '''
+    Return the tags of the images selected by the query of image ids in path order.
+    '''
+    def _list_tags(self, cur: sqlite3.Cursor, query: str, params: tuple = ()) -> List[tuple[int, str, List[str]]]:
+        cur.execute("SELECT i.id, i.path, t.name FROM (" + query + ") as q " \
+                    "JOIN images as i ON i.id = q.image_id " \
+                    "LEFT JOIN image_tags as it ON it.image_id = i.id " \
+                    "LEFT JOIN tags as t ON t.id = it.tag_id " \
+                    "ORDER BY i.path, it.position", params)
+        rows: List[tuple[int, str, List[str]]] = []
+        for (image_id, path), group in groupby(cur.fetchall(), key=lambda r: (r[0], r[1])):
+            rows.append((image_id, path, [name for _, _, name in group if name is not None]))
+        return rows
+    '''
+    Attach the index of files as read from disk as the schema 'idx'.
+    It is kept in memory unless an index path is given.
+    '''
+    def _attach_index(self):
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA database_list")
+        attached = {row[1]: row[2] for row in cur}
+        target = '' if self.index_path is None else str(self.index_path)
+        if 'idx' in attached and attached['idx'] == target:
+            return
+        if self.index_path is not None:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        # ATTACH is not allowed inside a transaction
+        self.conn.commit()
+        autocommit = self.conn.autocommit
+        self.conn.autocommit = True
+        try:
+            if 'idx' in attached:
+                cur.execute("DETACH DATABASE idx")
+            cur.execute("ATTACH DATABASE ? AS idx", (':memory:' if self.index_path is None else target, ))
+        finally:
+            self.conn.autocommit = autocommit
+        with Txn.begin(self.conn) as cur:
+            cur.execute("CREATE TABLE IF NOT EXISTS idx.files (" \
+                        "path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, caption_mtime INTEGER, tags JSON)")
+    '''
+    Record captions as written to disk with their mtime, so that they are not read again.
+    '''
+    def _mark_saved(self, cur: sqlite3.Cursor, saved: List[tuple[str, List[str], int]]):
+        cur.executemany("UPDATE idx.files SET tags = ?, caption_mtime = ? WHERE path = ?",
+                        [(json.dumps(tags), mtime, path) for path, tags, mtime in saved])
+        cur.executemany("UPDATE images SET dirty = 0 WHERE path = ?", [(path, ) for path, _, _ in saved])
+    '''
+    Bring idx.files and the working set in line with the files in the temporary table 'scan'.
+    When `scoped`, only the paths of the temporary table 'scope' are considered,
+    and files of the scope missing from 'scan' are deleted.
+    '''
+    def _apply(self, cur: sqlite3.Cursor, pool: ThreadPoolExecutor, result: LoadResult, discard: bool, scoped: bool = False):
+        # Read tags of new or changed files only
+        cur.execute("SELECT s.path, s.caption_mtime, f.path IS NULL FROM scan as s LEFT JOIN idx.files as f ON s.path = f.path " \
+                    "WHERE f.path IS NULL OR s.mtime IS NOT f.mtime OR s.size IS NOT f.size " \
+                    "OR s.caption_mtime IS NOT f.caption_mtime")
+        targets = cur.fetchall()
+        # Read tags from the caption file if exists
+        captions = pool.map(lambda t: [] if t[1] is None else _read_tags(Path(t[0]).with_suffix('.txt')), targets)
+        updates = []
+        changed: Set[str] = set()
+        for (p, _, is_new), tags in zip(targets, captions):
+            updates.append((p, json.dumps(tags)))
+            if is_new:
+                result.added += 1
+            else:
+                result.changed += 1
+                changed.add(p)
+        cur.executemany("INSERT OR REPLACE INTO idx.files (path, mtime, size, caption_mtime, tags) " \
+                        "SELECT path, mtime, size, caption_mtime, ? FROM scan WHERE path = ?",
+                        [(t, p) for p, t in updates])
+        cur.execute("DELETE FROM idx.files WHERE path NOT IN (SELECT path FROM scan)" + \
+                    (" AND path IN (SELECT path FROM scope)" if scoped else ""))
+        result.deleted = cur.rowcount
+        cur.execute("SELECT COUNT(*) FROM scan")
+        result.unchanged = cur.fetchone()[0] - result.added - result.changed
+        # Bring the working set in line with the files on disk
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS deleted (id INTEGER PRIMARY KEY)")
+        cur.execute("DELETE FROM deleted")
+        cur.execute("INSERT INTO deleted (id) SELECT id FROM images WHERE path NOT IN (SELECT path FROM idx.files)")
+        cur.execute("SELECT i.path FROM deleted as d, images as i WHERE i.id = d.id AND i.dirty = 1 ORDER BY i.path")
+        result.lost = [row[0] for row in cur]
+        self.journal.forget(cur, "SELECT id FROM deleted")
+        cur.execute("DELETE FROM image_tags WHERE image_id IN (SELECT id FROM deleted)")
+        cur.execute("DELETE FROM selected WHERE image_id IN (SELECT id FROM deleted)")
+        cur.execute("DELETE FROM images WHERE id IN (SELECT id FROM deleted)")
+        cur.execute("SELECT path FROM images WHERE dirty = 1")
+        dirty = set(row[0] for row in cur)
+        result.conflicts = sorted(dirty & changed)
+        # Take tags from the files for new images and changed images without unsaved tags
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS reset (id INTEGER PRIMARY KEY)")
+        cur.execute("DELETE FROM reset")
+        cur.executemany("INSERT OR IGNORE INTO reset (id) SELECT id FROM images WHERE path = ? AND dirty = 0",
+                        [(p, ) for p in changed])
+        if discard:
+            cur.execute("INSERT OR IGNORE INTO reset (id) SELECT id FROM images WHERE dirty = 1")
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM images")
+        last_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO images (path) SELECT path FROM idx.files WHERE path NOT IN (SELECT path FROM images)")
+        cur.execute("INSERT OR IGNORE INTO reset (id) SELECT id FROM images WHERE id > ?", (last_id, ))
+        cur.execute("INSERT OR IGNORE INTO tags (name) SELECT e.value FROM reset as r, images as i, idx.files as f, JSON_EACH(f.tags) as e " \
+                    "WHERE r.id = i.id AND i.path = f.path")
+        # the edits of images taken from disk can no longer be undone
+        self.journal.forget(cur, "SELECT id FROM reset")
+        cur.execute("DELETE FROM image_tags WHERE image_id IN (SELECT id FROM reset)")
+        cur.execute("INSERT INTO image_tags (image_id, tag_id, position) " \
+                    "SELECT i.id, t.id, e.key FROM reset as r, images as i, idx.files as f, JSON_EACH(f.tags) as e, tags as t " \
+                    "WHERE r.id = i.id AND i.path = f.path AND t.name = e.value")
+        cur.execute("UPDATE images SET dirty = 0 WHERE id IN (SELECT id FROM reset)")
+    '''
+    Apply the changes on disk of the given images and of the images under the given directories,
+    without scanning the whole dataset or changing the selection.
+    Unsaved tags of a file changed on disk are kept and reported as a conflict.
+    '''
+    def update(self, paths: Iterable[str], directories: Iterable[str] = ()) -> LoadResult:
+        log = logging.getLogger(__name__)
+        result = LoadResult()
+        start = time.perf_counter()
+        paths = set(paths)
+        with Txn.begin(self.conn) as cur:
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS scope (path TEXT PRIMARY KEY)")
+            cur.execute("DELETE FROM scope")
+            cur.execute("DELETE FROM scan")
+            with ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix='dataset-scan') as pool:
+                for d in directories:
+                    # files known under the directory, whether it still exists or not
+                    prefix = os.path.join(d, '')
+                    cur.execute("SELECT path FROM idx.files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+                    paths.update(row[0] for row in cur)
+                    if os.path.isdir(d):
+                        for rows in _scan(pool, d):
+                            paths.update(row[0] for row in rows)
+                cur.executemany("INSERT OR IGNORE INTO scope (path) VALUES (?)", [(p, ) for p in paths])
+                rows = [row for row in pool.map(_stat_image, paths) if row is not None]
+                cur.executemany("INSERT INTO scan (path, mtime, size, caption_mtime) VALUES (?, ?, ?, ?)", rows)
+                self._apply(cur, pool, result, discard=False, scoped=True)
+        result.elapsed = time.perf_counter() - start
+        if result.added or result.changed or result.deleted:
+            log.info(f'{result.added} added, {result.changed} changed, {result.deleted} deleted in {result.elapsed:.2f}s')
+        if result.conflicts:
+            log.warning(f'{len(result.conflicts)} files changed on disk while having unsaved tags: {", ".join(result.conflicts)}')
+        if result.lost:
+            log.warning(f'{len(result.lost)} files deleted on disk while having unsaved tags, which are lost: {", ".join(result.lost)}')
+        return result
     '''
     Load images as dataset from the given path.
     Create a table named 'images' if not there and set default values.
+    Only files which are new or changed since the last load are read.
+    Unsaved tags of a file changed on disk are kept and reported as a conflict
+    unless `discard` is set.
     '''
-    def load(self, path: Path):
+    def load(self, path: Path, discard: bool = False):
+        log = logging.getLogger(__name__)
+        self._attach_index()
+        result = LoadResult()
+        start = time.perf_counter()
         with Txn.begin(self.conn) as cur:
-            cur.execute("CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, tags JSON)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_images_tags ON images (JSON_EXTRACT(tags, '$'))")
-            cur.execute("DELETE FROM images")
-            for base, _, filenames in os.walk(path):
-                for n in filenames:
-                    image_filepath = Path(base)/n
-                    if not image_filepath.suffix.lower() in SUPPORTED_FORMATS:
-                        # Ignore unsupported formats
-                        continue
-                    caption_filepath = image_filepath.with_suffix('.txt')
-                    tags = []
-                    if caption_filepath.exists():
-                        # Read tags from the caption file if exists
-                        with open(caption_filepath, 'rt') as f:
-                            tags = [s.strip() for s in re.split(r',|\n|\r', f.read())]
-                    cur.execute("INSERT INTO images (path, tags) VALUES (?, ?)", (str(image_filepath), json.dumps(tags)))
+            cur.execute("CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, path TEXT UNIQUE, dirty INTEGER DEFAULT 0)")
+            cur.execute("CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+            cur.execute("CREATE TABLE IF NOT EXISTS image_tags (image_id INTEGER, tag_id INTEGER, position INTEGER, " \
+                        "PRIMARY KEY (image_id, position))")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_image_tags_tag ON image_tags (tag_id, image_id)")
+            # Images whose tags changed since the tag matrix was last refreshed
+            cur.execute("CREATE TABLE IF NOT EXISTS matrix_dirty (image_id INTEGER PRIMARY KEY)")
+            cur.execute("CREATE TRIGGER IF NOT EXISTS trg_image_tags_matrix_insert AFTER INSERT ON image_tags BEGIN " \
+                        "INSERT OR IGNORE INTO matrix_dirty (image_id) VALUES (NEW.image_id); " \
+                        "END")
+            cur.execute("CREATE TRIGGER IF NOT EXISTS trg_image_tags_matrix_delete AFTER DELETE ON image_tags BEGIN " \
+                        "INSERT OR IGNORE INTO matrix_dirty (image_id) VALUES (OLD.image_id); " \
+                        "END")
+            cur.execute("CREATE TRIGGER IF NOT EXISTS trg_image_tags_matrix_update AFTER UPDATE OF image_id, tag_id ON image_tags BEGIN " \
+                        "INSERT OR IGNORE INTO matrix_dirty (image_id) VALUES (OLD.image_id), (NEW.image_id); " \
+                        "END")
+            # Trigrams of the vocabulary for substring filters, following the tags table
+            cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tags_fts USING fts5 (name, content='tags', content_rowid='id', tokenize='trigram')")
+            cur.execute("CREATE TRIGGER IF NOT EXISTS trg_tags_insert AFTER INSERT ON tags BEGIN " \
+                        "INSERT INTO tags_fts (rowid, name) VALUES (NEW.id, NEW.name); " \
+                        "END")
+            cur.execute("CREATE TRIGGER IF NOT EXISTS trg_tags_delete AFTER DELETE ON tags BEGIN " \
+                        "INSERT INTO tags_fts (tags_fts, rowid, name) VALUES ('delete', OLD.id, OLD.name); " \
+                        "END")
+            cur.execute("CREATE TRIGGER IF NOT EXISTS trg_tags_update AFTER UPDATE OF name ON tags BEGIN " \
+                        "INSERT INTO tags_fts (tags_fts, rowid, name) VALUES ('delete', OLD.id, OLD.name); " \
+                        "INSERT INTO tags_fts (rowid, name) VALUES (NEW.id, NEW.name); " \
+                        "END")
+            # Deltas of the tag edits for undo and redo
+            Journal.create(cur)
+            cur.execute("CREATE TABLE IF NOT EXISTS selected (image_id INTEGER PRIMARY KEY)")
+            # Occurrences of each tag in the selected files, kept up to date on every tag edit
+            cur.execute("CREATE TABLE IF NOT EXISTS tag_counts (tag_id INTEGER PRIMARY KEY, count INTEGER)")
+            cur.execute("CREATE TRIGGER IF NOT EXISTS trg_image_tags_insert AFTER INSERT ON image_tags " \
+                        "WHEN EXISTS (SELECT 1 FROM selected WHERE image_id = NEW.image_id) BEGIN " \
+                        "INSERT INTO tag_counts (tag_id, count) VALUES (NEW.tag_id, 1) " \
+                        "ON CONFLICT (tag_id) DO UPDATE SET count = count + 1; " \
+                        "END")
+            cur.execute("CREATE TRIGGER IF NOT EXISTS trg_image_tags_delete AFTER DELETE ON image_tags " \
+                        "WHEN EXISTS (SELECT 1 FROM selected WHERE image_id = OLD.image_id) BEGIN " \
+                        "UPDATE tag_counts SET count = count - 1 WHERE tag_id = OLD.tag_id; " \
+                        "DELETE FROM tag_counts WHERE tag_id = OLD.tag_id AND count <= 0; " \
+                        "END")
+            cur.execute("CREATE TRIGGER IF NOT EXISTS trg_image_tags_update AFTER UPDATE OF tag_id ON image_tags " \
+                        "WHEN EXISTS (SELECT 1 FROM selected WHERE image_id = NEW.image_id) BEGIN " \
+                        "UPDATE tag_counts SET count = count - 1 WHERE tag_id = OLD.tag_id; " \
+                        "DELETE FROM tag_counts WHERE tag_id = OLD.tag_id AND count <= 0; " \
+                        "INSERT INTO tag_counts (tag_id, count) VALUES (NEW.tag_id, 1) " \
+                        "ON CONFLICT (tag_id) DO UPDATE SET count = count + 1; " \
+                        "END")
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS scan (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, caption_mtime INTEGER)")
+            cur.execute("DELETE FROM scan")
+            with ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix='dataset-scan') as pool:
+                for rows in _scan(pool, str(Path(path))):
+                    cur.executemany("INSERT INTO scan (path, mtime, size, caption_mtime) VALUES (?, ?, ?, ?)", rows)
+                self._apply(cur, pool, result, discard)
             self._select_all_files()
+        result.elapsed = time.perf_counter() - start
+        log.info(f'{result.files} files loaded in {result.elapsed:.2f}s ({result.files_per_second:.0f} files/s)')
+        if result.conflicts and not discard:
+            log.warning(f'{len(result.conflicts)} files changed on disk while having unsaved tags')
+        if result.lost:
+            log.warning(f'{len(result.lost)} files deleted on disk while having unsaved tags, which are lost: {", ".join(result.lost)}')
+        self.last_load = result
         return self
@@ -1,17 +1,33 @@
+import csv
 from pathlib import Path
-import pandas as pd
-from pydantic import BaseModel, ConfigDict
+from typing import Dict, Iterable, List, Optional
 
-class Dictionary(BaseModel):
-    model_config = ConfigDict(arbitrary_types_allowed=True)
-    data: pd.DataFrame = None
-    @classmethod
-    def load(cls, path:Path) -> 'Dictionary':
-        d = cls()
-        d.data = pd.read_csv(path, index_col=0)
-        return d
-    def __getitem__(self, key):
-        k = key.strip()
-        if not k in self.data.index:
-            return None
-        return self.data.loc[k, self.data.columns[0]]
+def normalize(key: str) -> str:
+    '''
+    Spell a tag as in the dictionary, where words are joined by underscores.
+    '''
+    return key.strip().replace(' ', '_')
+
+class Dictionary:
+    '''
+    Translations of tags read from a CSV file of (tag, text) rows.
+    The file is read on the first lookup, and keys are stored normalized
+    so that a tag is found with a single probe whichever spelling it uses.
+    '''
+    path: Path
+    _data: Optional[Dict[str, str]] = None
+    def __init__(self, path: Path) -> None:
+        self.path = path
+    @property
+    def data(self) -> Dict[str, str]:
+        if self._data is None:
+            with open(self.path, 'r', encoding='utf-8', newline='') as f:
+                self._data = {normalize(row[0]): row[1] for row in csv.reader(f) if len(row) >= 2}
+        return self._data
+    def __len__(self) -> int:
+        return len(self.data)
+    def __getitem__(self, key: str) -> Optional[str]:
+        return self.data.get(normalize(key))
+    def lookup_many(self, keys: Iterable[str]) -> List[Optional[str]]:
+        data = self.data
+        return [data.get(normalize(k)) for k in keys]
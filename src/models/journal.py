@@ -0,0 +1,138 @@
+from dataclasses import dataclass
+import sqlite3
+from typing import TYPE_CHECKING, Optional
+from controllers.transaction import Txn
+
+if TYPE_CHECKING:
+    from .dataset import Dataset
+
+@dataclass
+class JournalEntry:
+    op: int
+    label: str
+    files: int
+    rows: int
+
+class Journal:
+    '''
+    History of the tag edits as per-image deltas of image_tags, which can be undone and redone.
+    While recording, triggers copy the rows inserted into and deleted from image_tags to
+    'journal_rows' under the current operation, in the transaction of the edit itself.
+    An operation is closed by `end`, which keeps only the net changes, so the journal
+    grows with the size of the edits rather than of the dataset.
+
+        dataset.journal.begin('add tags 1girl')
+        ...  # edits calling `record` inside their transaction
+        dataset.journal.end()
+        dataset.journal.undo()
+    '''
+    dataset: 'Dataset'
+    op: int = 0
+    label: str = ''
+    # number of operations kept, older ones are forgotten
+    LIMIT = 100
+    def __init__(self, dataset: 'Dataset') -> None:
+        self.dataset = dataset
+    @staticmethod
+    def create(cur: sqlite3.Cursor) -> None:
+        '''
+        Create the tables and triggers of the journal.
+        '''
+        cur.execute("CREATE TABLE IF NOT EXISTS journal_state (op INTEGER, recording INTEGER)")
+        cur.execute("INSERT INTO journal_state (op, recording) SELECT 0, 0 WHERE NOT EXISTS (SELECT 1 FROM journal_state)")
+        cur.execute("CREATE TABLE IF NOT EXISTS journal_ops (id INTEGER PRIMARY KEY, label TEXT, undone INTEGER DEFAULT 0)")
+        # sign is 1 for a row inserted by the operation and -1 for a row deleted by it
+        cur.execute("CREATE TABLE IF NOT EXISTS journal_rows (op INTEGER, image_id INTEGER, tag_id INTEGER, position INTEGER, sign INTEGER)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_journal_rows_op ON journal_rows (op)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_journal_rows_image ON journal_rows (image_id)")
+        cur.execute("CREATE TRIGGER IF NOT EXISTS trg_image_tags_journal_insert AFTER INSERT ON image_tags " \
+                    "WHEN (SELECT recording FROM journal_state) BEGIN " \
+                    "INSERT INTO journal_rows (op, image_id, tag_id, position, sign) " \
+                    "SELECT op, NEW.image_id, NEW.tag_id, NEW.position, 1 FROM journal_state; " \
+                    "END")
+        cur.execute("CREATE TRIGGER IF NOT EXISTS trg_image_tags_journal_delete AFTER DELETE ON image_tags " \
+                    "WHEN (SELECT recording FROM journal_state) BEGIN " \
+                    "INSERT INTO journal_rows (op, image_id, tag_id, position, sign) " \
+                    "SELECT op, OLD.image_id, OLD.tag_id, OLD.position, -1 FROM journal_state; " \
+                    "END")
+        cur.execute("CREATE TRIGGER IF NOT EXISTS trg_image_tags_journal_update AFTER UPDATE ON image_tags " \
+                    "WHEN (SELECT recording FROM journal_state) BEGIN " \
+                    "INSERT INTO journal_rows (op, image_id, tag_id, position, sign) " \
+                    "SELECT op, OLD.image_id, OLD.tag_id, OLD.position, -1 FROM journal_state; " \
+                    "INSERT INTO journal_rows (op, image_id, tag_id, position, sign) " \
+                    "SELECT op, NEW.image_id, NEW.tag_id, NEW.position, 1 FROM journal_state; " \
+                    "END")
+    def begin(self, label: str) -> None:
+        '''
+        Start an operation, the edits recorded until `end` are undone together.
+        '''
+        with Txn.begin(self.dataset.conn) as cur:
+            cur.execute("SELECT MAX(COALESCE((SELECT MAX(id) FROM journal_ops), 0), COALESCE((SELECT MAX(op) FROM journal_rows), 0)) + 1")
+            self.op = cur.fetchone()[0]
+            self.label = label
+            cur.execute("UPDATE journal_state SET op = ?, recording = 0", (self.op, ))
+    def record(self, cur: sqlite3.Cursor, enabled: bool = True) -> None:
+        '''
+        Turn the recording of image_tags changes on or off, within the transaction of an edit.
+        '''
+        cur.execute("UPDATE journal_state SET recording = ?", (int(enabled), ))
+    def end(self) -> Optional[JournalEntry]:
+        '''
+        Close the current operation and return it, or None if it changed nothing.
+        A new operation drops the operations which were undone.
+        '''
+        with Txn.begin(self.dataset.conn) as cur:
+            cur.execute("UPDATE journal_state SET recording = 0")
+            # a caption replaced as a whole leaves the rows it kept with a sum of zero
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS journal_net (image_id INTEGER, tag_id INTEGER, position INTEGER, sign INTEGER)")
+            cur.execute("DELETE FROM journal_net")
+            cur.execute("INSERT INTO journal_net (image_id, tag_id, position, sign) " \
+                        "SELECT image_id, tag_id, position, SUM(sign) FROM journal_rows WHERE op = ? " \
+                        "GROUP BY image_id, tag_id, position HAVING SUM(sign) <> 0", (self.op, ))
+            cur.execute("DELETE FROM journal_rows WHERE op = ?", (self.op, ))
+            cur.execute("SELECT COUNT(*), COUNT(DISTINCT image_id) FROM journal_net")
+            rows, files = cur.fetchone()
+            if rows == 0:
+                return None
+            cur.execute("INSERT INTO journal_rows (op, image_id, tag_id, position, sign) " \
+                        "SELECT ?, image_id, tag_id, position, sign FROM journal_net", (self.op, ))
+            cur.execute("DELETE FROM journal_rows WHERE op IN (SELECT id FROM journal_ops WHERE undone = 1)")
+            cur.execute("DELETE FROM journal_ops WHERE undone = 1")
+            cur.execute("INSERT INTO journal_ops (id, label) VALUES (?, ?)", (self.op, self.label))
+            cur.execute("DELETE FROM journal_ops WHERE id <= ?", (self.op - self.LIMIT, ))
+            cur.execute("DELETE FROM journal_rows WHERE op <= ?", (self.op - self.LIMIT, ))
+            return JournalEntry(self.op, self.label, files, rows)
+    def forget(self, cur: sqlite3.Cursor, query: str) -> None:
+        '''
+        Drop the history of the image ids returned by the query, whose tags were taken from disk.
+        '''
+        cur.execute("DELETE FROM journal_rows WHERE image_id IN (" + query + ")")
+        cur.execute("DELETE FROM journal_ops WHERE id NOT IN (SELECT op FROM journal_rows)")
+    def undo(self) -> Optional[JournalEntry]:
+        '''
+        Revert the last operation which is not undone, None if there is none.
+        '''
+        return self._apply("SELECT id, label FROM journal_ops WHERE undone = 0 ORDER BY id DESC LIMIT 1", -1)
+    def redo(self) -> Optional[JournalEntry]:
+        '''
+        Apply again the first operation which was undone, None if there is none.
+        '''
+        return self._apply("SELECT id, label FROM journal_ops WHERE undone = 1 ORDER BY id LIMIT 1", 1)
+    def _apply(self, query: str, direction: int) -> Optional[JournalEntry]:
+        with Txn.begin(self.dataset.conn) as cur:
+            cur.execute(query)
+            row = cur.fetchone()
+            if row is None:
+                return None
+            op, label = row
+            # rows leaving first, as the rows entering take their positions
+            cur.execute("DELETE FROM image_tags WHERE (image_id, position, tag_id) IN " \
+                        "(SELECT image_id, position, tag_id FROM journal_rows WHERE op = ? AND sign = ?)", (op, -direction))
+            rows = cur.rowcount
+            cur.execute("INSERT INTO image_tags (image_id, tag_id, position) " \
+                        "SELECT image_id, tag_id, position FROM journal_rows WHERE op = ? AND sign = ?", (op, direction))
+            rows += cur.rowcount
+            cur.execute("UPDATE journal_ops SET undone = ? WHERE id = ?", (int(direction < 0), op))
+            # undo may bring files back to their caption on disk
+            files = self.dataset._mark_dirty(cur, "SELECT DISTINCT image_id FROM journal_rows WHERE op = ?", (op, ))
+            return JournalEntry(op, label, files, rows)
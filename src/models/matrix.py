@@ -0,0 +1,63 @@
+import json
+import sqlite3
+from typing import List
+import numpy as np
+from scipy.sparse import csr_matrix
+
+class TagMatrix:
+    '''
+    Binary matrix of images by tags in CSR form, where row i is the image with id i
+    and column j the tag with id j.
+    Triggers on image_tags record the images whose tags changed in 'matrix_dirty',
+    and only their rows are read again on the next refresh.
+    '''
+    matrix: csr_matrix = None
+    # above this share of dirty rows, reading the whole table is cheaper
+    REBUILD_RATIO = 0.25
+    def refresh(self, cur: sqlite3.Cursor) -> csr_matrix:
+        cur.execute("SELECT COUNT(*) FROM matrix_dirty")
+        dirty = cur.fetchone()[0]
+        if self.matrix is not None and dirty == 0:
+            return self.matrix
+        if self.matrix is None or dirty > self.matrix.shape[0] * self.REBUILD_RATIO:
+            cur.execute("SELECT image_id, tag_id FROM image_tags")
+            rows, cols = self._pairs(cur.fetchall())
+        else:
+            cur.execute("SELECT image_id FROM matrix_dirty")
+            ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+            coo = self.matrix.tocoo()
+            keep = ~np.isin(coo.row, ids)
+            cur.execute("SELECT it.image_id, it.tag_id FROM matrix_dirty as d, image_tags as it WHERE it.image_id = d.image_id")
+            rows, cols = self._pairs(cur.fetchall())
+            rows = np.concatenate([coo.row[keep].astype(np.int64), rows])
+            cols = np.concatenate([coo.col[keep].astype(np.int64), cols])
+        cur.execute("SELECT COALESCE(MAX(id), -1) + 1 FROM images")
+        height = max(cur.fetchone()[0], int(rows.max(initial=-1)) + 1)
+        cur.execute("SELECT COALESCE(MAX(id), -1) + 1 FROM tags")
+        width = max(cur.fetchone()[0], int(cols.max(initial=-1)) + 1)
+        matrix = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(height, width))
+        # a tag repeated in a caption is counted once
+        matrix.data[:] = 1
+        self.matrix = matrix
+        cur.execute("DELETE FROM matrix_dirty")
+        return matrix
+    @staticmethod
+    def _pairs(pairs: List[tuple[int, int]]) -> tuple[np.ndarray, np.ndarray]:
+        a = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        return a[:, 0], a[:, 1]
+
+def selected_rows(cur: sqlite3.Cursor, matrix: csr_matrix) -> csr_matrix:
+    '''
+    Return the rows of the selected images.
+    '''
+    cur.execute("SELECT image_id FROM selected ORDER BY image_id")
+    ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+    return matrix[ids]
+
+def tag_names(cur: sqlite3.Cursor, ids: np.ndarray) -> List[str]:
+    '''
+    Return the names of the tag ids, in the same order.
+    '''
+    cur.execute("SELECT t.name FROM json_each(?) as j, tags as t WHERE t.id = j.value ORDER BY j.key",
+                (json.dumps([int(i) for i in ids]), ))
+    return [row[0] for row in cur.fetchall()]
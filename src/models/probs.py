@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+from controllers.transaction import Txn
+
+PROBS_DTYPE = np.float16
+
+def content_hash(path: Path) -> str:
+    '''
+    Return a digest of the file content, independent of its path and mtime.
+    '''
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+def hash_files(files: List[Path], workers: int) -> List[Optional[str]]:
+    '''
+    Return the content hash of the files, None for those which cannot be read.
+    '''
+    def _hash(file: Path) -> Optional[str]:
+        try:
+            return content_hash(file)
+        except OSError:
+            # reported again when the image is loaded
+            return None
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='infer-hash') as pool:
+        return list(pool.map(_hash, files))
+
+class ProbabilityStore:
+    '''
+    Raw sigmoid outputs of one model, keyed by image content hash.
+    Vectors are appended as float16 rows to a flat file which is read through
+    a memory map, and the row of each hash is recorded in a SQLite index.
+    '''
+    path: Path
+    labels: int
+    conn: sqlite3.Connection
+    _rows: int
+    _mmap: np.memmap = None
+    def __init__(self, path: Path, labels: int) -> None:
+        self.path = path
+        self.labels = labels
+        path.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path/'index.db', autocommit=False)
+        with Txn.begin(self.conn) as cur:
+            cur.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+            cur.execute("CREATE TABLE IF NOT EXISTS probs (hash TEXT PRIMARY KEY, row INTEGER)")
+            cur.execute("SELECT value FROM meta WHERE key = 'labels'")
+            row = cur.fetchone()
+            if row is not None and row[0] != labels:
+                # the label set of the model has changed, cached vectors are useless
+                logging.getLogger(__name__).warning(f'Label count changed in "{path}", discarding cached probabilities')
+                cur.execute("DELETE FROM probs")
+                self._data_path.unlink(missing_ok=True)
+            cur.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('labels', ?)", (labels, ))
+            # drop a partially written row left by an interrupted run
+            self._rows = self._data_path.stat().st_size // self._row_size if self._data_path.exists() else 0
+            if self._data_path.exists():
+                os.truncate(self._data_path, self._rows * self._row_size)
+            cur.execute("DELETE FROM probs WHERE row >= ?", (self._rows, ))
+    @property
+    def _data_path(self) -> Path:
+        return self.path/'probs.f16'
+    @property
+    def _row_size(self) -> int:
+        return self.labels * np.dtype(PROBS_DTYPE).itemsize
+    def __len__(self) -> int:
+        return self._rows
+    def find(self, hashes: List[str]) -> Dict[str, int]:
+        '''
+        Return the row of each hash which has a cached vector.
+        '''
+        found: Dict[str, int] = {}
+        with Txn.begin(self.conn) as cur:
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (hash TEXT PRIMARY KEY)")
+            cur.execute("DELETE FROM lookup")
+            cur.executemany("INSERT OR IGNORE INTO lookup (hash) VALUES (?)", [(h, ) for h in hashes])
+            cur.execute("SELECT p.hash, p.row FROM probs as p, lookup as l WHERE p.hash = l.hash")
+            for h, row in cur:
+                found[h] = row
+        return found
+    def read(self, rows: List[int]) -> np.ndarray:
+        if self._mmap is None or self._mmap.shape[0] < self._rows:
+            self._mmap = np.memmap(self._data_path, dtype=PROBS_DTYPE, mode='r', shape=(self._rows, self.labels))
+        return self._mmap[rows].astype(np.float32)
+    def write(self, hashes: List[str], probs: np.ndarray) -> None:
+        if probs.shape != (len(hashes), self.labels):
+            raise ValueError(f'Expected {(len(hashes), self.labels)} probabilities, got {probs.shape}')
+        with open(self._data_path, 'ab') as f:
+            f.write(np.ascontiguousarray(probs, dtype=PROBS_DTYPE).tobytes())
+        with Txn.begin(self.conn) as cur:
+            cur.executemany("INSERT OR REPLACE INTO probs (hash, row) VALUES (?, ?)",
+                            [(h, self._rows + i) for i, h in enumerate(hashes)])
+        self._rows += len(hashes)
+    def close(self) -> None:
+        self._mmap = None
+        self.conn.close()
@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from controllers.transaction import Txn
+
+# rows of a shard file, each shard holds at most this many preprocessed images
+SHARD_ROWS = 256
+
+def config_key(description: str) -> str:
+    '''
+    Return the directory name of the tensors of a preprocessing configuration.
+    '''
+    return hashlib.blake2b(description.encode(), digest_size=8).hexdigest()
+
+class TensorStore:
+    '''
+    Preprocessed model inputs of one preprocessing configuration, keyed by image content hash.
+    Inputs are appended as rows of fixed shape and dtype to shard files of SHARD_ROWS rows,
+    which are read through memory maps, and the row of each hash is recorded in a SQLite index.
+    '''
+    path: Path
+    shape: Tuple[int, ...]
+    dtype: np.dtype
+    description: str
+    conn: sqlite3.Connection
+    _rows: int
+    _maps: Dict[int, np.memmap]
+    _lock: threading.Lock
+    def __init__(self, path: Path, shape: Iterable[int], dtype, description: str = '',
+                 conn: Optional[sqlite3.Connection] = None) -> None:
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.description = description
+        self._maps = {}
+        self._lock = threading.Lock()
+        if conn is not None:
+            # opened as is, see `open`
+            self.conn = conn
+            self._rows = self._count_rows()
+            return
+        path.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path/'index.db', autocommit=False)
+        with Txn.begin(self.conn) as cur:
+            cur.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+            cur.execute("CREATE TABLE IF NOT EXISTS tensors (hash TEXT PRIMARY KEY, row INTEGER)")
+            cur.execute("SELECT value FROM meta WHERE key = 'layout'")
+            row = cur.fetchone()
+            layout = f'{self.dtype.str} {self.shape}'
+            if row is not None and row[0] != layout:
+                logging.getLogger(__name__).warning(f'Tensor layout changed in "{path}", discarding cached tensors')
+                cur.execute("DELETE FROM tensors")
+                self._clear()
+            elif (path/'compact').is_dir():
+                # a prune was interrupted, the shards are intact as long as its index was not cleared
+                shutil.rmtree(path/'compact')
+                cur.execute("SELECT EXISTS (SELECT 1 FROM tensors)")
+                if not cur.fetchone()[0]:
+                    logging.getLogger(__name__).warning(f'Interrupted prune in "{path}", discarding cached tensors')
+                    self._clear()
+            cur.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('layout', ?), ('description', ?)", (layout, description))
+            # drop a partially written row left by an interrupted run
+            shards = self._shards()
+            self._rows = self._count_rows()
+            if shards:
+                os.truncate(shards[-1], (self._rows - (len(shards) - 1) * SHARD_ROWS) * self._row_size)
+            cur.execute("DELETE FROM tensors WHERE row >= ?", (self._rows, ))
+    @classmethod
+    def open(cls, path: Path, readonly: bool = False) -> 'TensorStore':
+        '''
+        Open an existing store with the layout it was written with, as is: unlike a store
+        opened for inference, the leftovers of an interrupted run are neither dropped nor
+        truncated, which could cut a row another process is appending. A partial last row
+        is ignored. With `readonly`, the index is opened read only.
+        '''
+        uri = (path/'index.db').resolve().as_uri() + ('?mode=ro' if readonly else '')
+        conn = sqlite3.connect(uri, uri=True, autocommit=False)
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        except sqlite3.Error:
+            conn.close()
+            raise
+        dtype, shape = meta['layout'].split(' ', 1)
+        return cls(path, tuple(int(x) for x in shape.strip('(,)').split(',')), dtype, meta.get('description', ''), conn=conn)
+    @property
+    def _row_size(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+    def _shard_path(self, shard: int) -> Path:
+        return self.path/f'shard-{shard:05d}.bin'
+    def _shards(self) -> List[Path]:
+        return sorted(self.path.glob('shard-*.bin'))
+    def _count_rows(self) -> int:
+        # shards before the last one are full
+        shards = self._shards()
+        return (len(shards) - 1) * SHARD_ROWS + shards[-1].stat().st_size // self._row_size if shards else 0
+    def _clear(self) -> None:
+        shutil.rmtree(self.path/'compact', ignore_errors=True)
+        for shard in self._shards():
+            shard.unlink()
+    def __len__(self) -> int:
+        return self._rows
+    @property
+    def nbytes(self) -> int:
+        return sum(s.stat().st_size for s in self._shards())
+    def find(self, hashes: List[str]) -> Dict[str, int]:
+        '''
+        Return the row of each hash which has cached tensors.
+        '''
+        found: Dict[str, int] = {}
+        with Txn.begin(self.conn) as cur:
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (hash TEXT PRIMARY KEY)")
+            cur.execute("DELETE FROM lookup")
+            cur.executemany("INSERT OR IGNORE INTO lookup (hash) VALUES (?)", [(h, ) for h in hashes])
+            cur.execute("SELECT t.hash, t.row FROM tensors as t, lookup as l WHERE t.hash = l.hash")
+            for h, row in cur:
+                found[h] = row
+        return found
+    def view(self, row: int) -> np.ndarray:
+        '''
+        Return a view of a row in the memory map of its shard, without copying it.
+        Rows are safe to read from several threads.
+        '''
+        shard, offset = divmod(row, SHARD_ROWS)
+        mmap = self._maps.get(shard)
+        if mmap is None or mmap.shape[0] <= offset:
+            with self._lock:
+                rows = self._shard_path(shard).stat().st_size // self._row_size
+                # copy on write, so that the view can back a tensor which is never written
+                mmap = np.memmap(self._shard_path(shard), dtype=self.dtype, mode='c', shape=(rows, ) + self.shape)
+                self._maps[shard] = mmap
+        return mmap[offset]
+    def write(self, hashes: List[str], tensors: np.ndarray) -> None:
+        if tensors.shape != (len(hashes), ) + self.shape:
+            raise ValueError(f'Expected {(len(hashes), ) + self.shape} tensors, got {tensors.shape}')
+        data = np.ascontiguousarray(tensors, dtype=self.dtype)
+        written = 0
+        while written < len(hashes):
+            shard, offset = divmod(self._rows + written, SHARD_ROWS)
+            count = min(SHARD_ROWS - offset, len(hashes) - written)
+            with open(self._shard_path(shard), 'ab') as f:
+                f.write(data[written:written + count].tobytes())
+            written += count
+        with Txn.begin(self.conn) as cur:
+            cur.executemany("INSERT OR REPLACE INTO tensors (hash, row) VALUES (?, ?)",
+                            [(h, self._rows + i) for i, h in enumerate(hashes)])
+        self._rows += len(hashes)
+    def prune(self, keep: Optional[Set[str]] = None) -> int:
+        '''
+        Remove the tensors of the hashes not in `keep`, all of them when it is None,
+        and compact the shards. Return the number of rows removed.
+        '''
+        with Txn.begin(self.conn) as cur:
+            cur.execute("SELECT hash, row FROM tensors ORDER BY row")
+            live = [(h, row) for h, row in cur.fetchall() if keep is not None and h in keep]
+        removed = self._rows - len(live)
+        if removed == 0:
+            return 0
+        # copy the live rows to new shards, then swap them in
+        old = self._shards()
+        compacted = self.path/'compact'
+        shutil.rmtree(compacted, ignore_errors=True)
+        compacted.mkdir()
+        for start in range(0, len(live), SHARD_ROWS):
+            rows = np.stack([self.view(row) for _, row in live[start:start + SHARD_ROWS]])
+            with open(compacted/f'shard-{start // SHARD_ROWS:05d}.bin', 'wb') as f:
+                f.write(rows.tobytes())
+        self._maps.clear()
+        # no row may point into the shards while they are swapped, an interrupted prune loses the cache
+        # but never maps a hash to the pixels of another image
+        with Txn.begin(self.conn) as cur:
+            cur.execute("DELETE FROM tensors")
+        for s in old:
+            s.unlink()
+        for s in sorted(compacted.iterdir()):
+            s.rename(self.path/s.name)
+        compacted.rmdir()
+        with Txn.begin(self.conn) as cur:
+            cur.executemany("INSERT INTO tensors (hash, row) VALUES (?, ?)", [(h, i) for i, (h, _) in enumerate(live)])
+        self._rows = len(live)
+        return removed
+    def close(self) -> None:
+        self._maps.clear()
+        self.conn.close()
+
+def list_stores(path: Path, readonly: bool = False) -> List[TensorStore]:
+    '''
+    Open the stores of every preprocessing configuration under the path, see `TensorStore.open`.
+    '''
+    if not path.is_dir():
+        return []
+    return [TensorStore.open(p, readonly) for p in sorted(path.iterdir()) if (p/'index.db').exists()]
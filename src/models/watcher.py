@@ -0,0 +1,186 @@
+import ctypes
+import ctypes.util
+from dataclasses import dataclass, field
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+from .dataset import SUPPORTED_FORMATS, _scan_directory
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+# struct inotify_event without the name which follows it
+_EVENT = struct.Struct('iIII')
+# directory of the files written by the tool itself
+IGNORED_DIRECTORY = '.tagger'
+
+@dataclass
+class Changes:
+    # images which may have been created, modified or deleted
+    paths: Set[str] = field(default_factory=set)
+    # directories whose whole content may have changed
+    directories: Set[str] = field(default_factory=set)
+    def __bool__(self) -> bool:
+        return bool(self.paths) or bool(self.directories)
+
+class Watcher:
+    '''
+    Collect the changes of images and captions under a directory from a background thread,
+    with inotify on Linux and by polling the directory tree elsewhere.
+    Events are coalesced per path until `drain` is called. The database is only
+    updated by the caller, as the SQLite connection belongs to the main thread.
+    '''
+    root: str
+    interval: float
+    _changes: Changes
+    _lock: threading.Lock
+    _stop: threading.Event
+    _thread: Optional[threading.Thread] = None
+    # inotify watch descriptors and their directories
+    _directories: Dict[int, str]
+    def __init__(self, root: str, interval: float = 2.0) -> None:
+        self.root = root
+        self.interval = interval
+        self._changes = Changes()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._directories = {}
+    def start(self) -> 'Watcher':
+        '''
+        Start watching, the changes made after this returns are all reported.
+        '''
+        fd = _inotify_init() if sys.platform.startswith('linux') else None
+        if fd is None:
+            # the first snapshot is taken before the thread starts
+            snapshot = self._snapshot()
+            target = lambda: self._poll(snapshot)
+        else:
+            # the watches are in place before returning, so that a load that follows misses nothing
+            self._watch(fd, self.root)
+            target = lambda: self._inotify(fd)
+        self._thread = threading.Thread(target=target, name='dataset-watcher', daemon=True)
+        self._thread.start()
+        return self
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    def drain(self) -> Changes:
+        '''
+        Return the changes since the last call.
+        '''
+        with self._lock:
+            changes, self._changes = self._changes, Changes()
+        return changes
+    def _record(self, path: str, is_dir: bool = False) -> None:
+        if IGNORED_DIRECTORY in path.split(os.sep):
+            return
+        stem, suffix = os.path.splitext(path)
+        with self._lock:
+            if is_dir:
+                self._changes.directories.add(path)
+            elif suffix.lower() in SUPPORTED_FORMATS:
+                self._changes.paths.add(path)
+            elif suffix == '.txt':
+                # the image of a caption may have any of the supported extensions
+                self._changes.paths.update(stem + e for f in SUPPORTED_FORMATS for e in (f, f.upper()))
+    def _watch(self, fd: int, path: str) -> None:
+        # watch a directory and everything below it
+        log = logging.getLogger(__name__)
+        pending = [path]
+        while pending:
+            d = pending.pop()
+            if os.path.basename(d) == IGNORED_DIRECTORY:
+                continue
+            wd = _libc.inotify_add_watch(fd, os.fsencode(d), WATCH_MASK)
+            if wd < 0:
+                log.warning(f'Failed to watch "{d}": {os.strerror(ctypes.get_errno())}')
+                continue
+            self._directories[wd] = d
+            pending.extend(_scan_directory(d)[1])
+    def _inotify(self, fd: int) -> None:
+        directories = self._directories
+        try:
+            while not self._stop.is_set():
+                ready, _, _ = select.select([fd], [], [], 0.5)
+                if not ready:
+                    continue
+                try:
+                    data = os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                    name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                    offset += _EVENT.size + length
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost, look at everything again
+                        self._record(self.root, is_dir=True)
+                        continue
+                    if mask & IN_IGNORED:
+                        directories.pop(wd, None)
+                        continue
+                    parent = directories.get(wd)
+                    if parent is None or len(name) == 0:
+                        continue
+                    path = os.path.join(parent, os.fsdecode(name))
+                    if mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            self._watch(fd, path)
+                        self._record(path, is_dir=True)
+                    else:
+                        self._record(path)
+        finally:
+            os.close(fd)
+    def _poll(self, snapshot: Dict[str, Tuple[int, int, Optional[int]]]) -> None:
+        while not self._stop.wait(self.interval):
+            current = self._snapshot()
+            for path in snapshot.keys() | current.keys():
+                if snapshot.get(path) != current.get(path):
+                    self._record(path)
+            snapshot = current
+    def _snapshot(self) -> Dict[str, Tuple[int, int, Optional[int]]]:
+        rows: Dict[str, Tuple[int, int, Optional[int]]] = {}
+        pending = [self.root]
+        while pending:
+            d = pending.pop()
+            if os.path.basename(d) == IGNORED_DIRECTORY:
+                continue
+            files, directories = _scan_directory(d)
+            rows.update((path, (mtime, size, caption_mtime)) for path, mtime, size, caption_mtime in files)
+            pending.extend(directories)
+        return rows
+
+_libc = None
+
+def _inotify_init() -> Optional[int]:
+    # inotify through libc, None when it is not available
+    global _libc
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        logging.getLogger(__name__).warning(f'inotify is not available: {os.strerror(ctypes.get_errno())}, polling instead')
+        return None
+    return fd
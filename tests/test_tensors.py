@@ -0,0 +1,79 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent/'src'))
+from models.tensors import SHARD_ROWS, TensorStore
+
+SHAPE = (3, 4, 4)
+
+def _store(path: Path, count: int) -> TensorStore:
+    # each row is filled with its index, so that a row read for the wrong hash shows
+    store = TensorStore(path, SHAPE, np.uint8)
+    store.write([f'h{i}' for i in range(count)], np.stack([np.full(SHAPE, i % 256, dtype=np.uint8) for i in range(count)]))
+    return store
+
+def _check(store: TensorStore) -> int:
+    rows = store.find([f'h{i}' for i in range(SHARD_ROWS * 3)])
+    for h, row in rows.items():
+        assert (store.view(row) == int(h[1:]) % 256).all(), h
+    return len(rows)
+
+@pytest.mark.parametrize('fail', ['write', 'unlink', 'rename'])
+def test_interrupted_prune(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, fail: str):
+    store = _store(tmp_path, SHARD_ROWS * 2 + 10)
+    keep = set(f'h{i}' for i in range(SHARD_ROWS * 2 + 10) if i % 3 != 0)
+    calls = []
+    def interrupt(original):
+        def wrapper(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return original(*args, **kwargs)
+        return wrapper
+    if fail == 'write':
+        monkeypatch.setattr(np, 'stack', interrupt(np.stack))
+    else:
+        monkeypatch.setattr(Path, fail, interrupt(getattr(Path, fail)))
+    with pytest.raises(KeyboardInterrupt):
+        store.prune(keep)
+    monkeypatch.undo()
+    store.close()
+    store = TensorStore(tmp_path, SHAPE, np.uint8)
+    found = _check(store)
+    # the shards are untouched until the index is cleared
+    assert found == (SHARD_ROWS * 2 + 10 if fail == 'write' else 0)
+    assert not (tmp_path/'compact').exists()
+    # the store keeps working after the recovery
+    store.write(['h1'], np.full((1, ) + SHAPE, 1, dtype=np.uint8))
+    assert _check(store) == found + (0 if fail == 'write' else 1)
+    store.close()
+
+def test_prune(tmp_path: Path):
+    store = _store(tmp_path, SHARD_ROWS * 2 + 10)
+    keep = set(f'h{i}' for i in range(SHARD_ROWS * 2 + 10) if i % 3 != 0)
+    assert store.prune(keep) == SHARD_ROWS * 2 + 10 - len(keep)
+    assert _check(store) == len(keep)
+    store.close()
+    store = TensorStore(tmp_path, SHAPE, np.uint8)
+    assert len(store) == len(keep)
+    assert _check(store) == len(keep)
+    store.close()
+
+def test_open_as_is(tmp_path: Path):
+    store = _store(tmp_path, 10)
+    store.close()
+    # a row being appended by another process
+    shard = tmp_path/'shard-00000.bin'
+    with open(shard, 'ab') as f:
+        f.write(b'\0' * 5)
+    size = shard.stat().st_size
+    index = (tmp_path/'index.db').read_bytes()
+    store = TensorStore.open(tmp_path, readonly=True)
+    assert store.shape == SHAPE and store.dtype == np.uint8
+    assert len(store) == 10
+    assert _check(store) == 10
+    store.close()
+    assert shard.stat().st_size == size
+    assert (tmp_path/'index.db').read_bytes() == index